@@ -10,11 +10,43 @@ def euclidean_distance(row1, row2):
     return distance
 
 
+# Upper bound in bytes for a tile of a pairwise distance matrix
+MEMORY_LIMIT = 256 * 2 ** 20
+
+
 # Returns mean row of cluster as center
 def get_center(cluster):
-    column_values = [cluster[:, i] for i in range(cluster.shape[1])]
-    center = [np.sum(column_values[i]) / cluster.shape[0] for i in range(cluster.shape[1])]
-    return center
+    return np.sum(cluster, axis=0) / cluster.shape[0]
+
+
+# Yields the squared Euclidean distances between rows1 and rows2 as (start1, start2, tile) in square tiles of at
+# most memory_limit bytes. With symmetric=True rows2 is rows1 and only the tiles on and above the diagonal are made
+def distance_tiles(rows1, rows2, symmetric=False, memory_limit=MEMORY_LIMIT):
+    block_size = max(1, int(np.sqrt(memory_limit // 8)))
+    norms1 = np.einsum('ij,ij->i', rows1, rows1)
+    norms2 = norms1 if symmetric else np.einsum('ij,ij->i', rows2, rows2)
+    for start1 in range(0, rows1.shape[0], block_size):
+        for start2 in range(start1 if symmetric else 0, rows2.shape[0], block_size):
+            tile = np.dot(rows1[start1:start1 + block_size], rows2[start2:start2 + block_size].T)
+            tile *= -2
+            tile += norms1[start1:start1 + block_size, np.newaxis]
+            tile += norms2[start2:start2 + block_size]
+            np.maximum(tile, 0, out=tile)
+            yield start1, start2, tile
+
+
+# Returns the minimum distance between a row of rows1 and a row of rows2, or with symmetric=True the maximum
+# distance between two rows of rows1. Only the running extreme of the tiles is kept, and the distance of the
+# chosen pair is computed again directly since the tiles lose precision for close rows
+def extreme_distance(rows1, rows2, symmetric=False, memory_limit=MEMORY_LIMIT):
+    rows1 = np.asarray(rows1, dtype=float)
+    rows2 = rows1 if symmetric else np.asarray(rows2, dtype=float)
+    best = None
+    for start1, start2, tile in distance_tiles(rows1, rows2, symmetric, memory_limit):
+        i, j = np.unravel_index(np.argmax(tile) if symmetric else np.argmin(tile), tile.shape)
+        if best is None or (tile[i, j] > best[0] if symmetric else tile[i, j] < best[0]):
+            best = (tile[i, j], start1 + i, start2 + j)
+    return np.sqrt(np.sum((rows1[best[1]] - rows2[best[2]]) ** 2))
 
 
 ##############################################
@@ -27,12 +59,9 @@ class RMSSTD:
     # Suppose set D contains n nodes with p dimensions. Sum of square parameter obtain as following function
     @staticmethod
     def sum_of_square(nodes_group):
-        center = get_center(nodes_group)
-        SS = 0
-        for node in nodes_group:
-            dist_square = euclidean_distance(node, center) ** 2
-            SS += dist_square
-        return SS
+        if nodes_group.shape[0] == 0:
+            return 0
+        return np.sum((nodes_group - get_center(nodes_group)) ** 2)
 
     def RMDDTD_index(self):
         K = len(self.clusters)
@@ -53,33 +82,24 @@ class RMSSTD:
 ################
 class Dunn:
     # Returns Dunn's index value with getting a list from clusters in input
-    def __init__(self, clusters_list):
+    def __init__(self, clusters_list, memory_limit=MEMORY_LIMIT):
         # Initializing parameters
         self.clusters = clusters_list
+        self.memory_limit = memory_limit
         self.separability = 0
         self.compactness = float('inf')
 
-    # The first parameter of Dunn's index
+    # The first parameter of Dunn's index, the minimum distance between the rows of two clusters
     def separability_calculation(self, cluster1, cluster2):
-        dist_list = list()
-        for row1 in cluster1:
-            for row2 in cluster2:
-                distance = euclidean_distance(row1, row2)
-                dist_list.append(distance)
-        if dist_list:
-            self.separability = min(dist_list)
+        if cluster1.shape[0] and cluster2.shape[0]:
+            self.separability = extreme_distance(cluster1, cluster2, memory_limit=self.memory_limit)
         else:
             self.separability = 0
 
-    # The second parameter of Dunn's index
+    # The second parameter of Dunn's index, the maximum distance between two rows of a cluster
     def compactness_calculation(self, cluster):
-        dist_list = list()
-        for i in range(cluster.shape[0]):
-            for j in range(i + 1, cluster.shape[0]):
-                distance = euclidean_distance(cluster[i], cluster[j])
-                dist_list.append(distance)
-        if dist_list:
-            self.compactness = max(dist_list)
+        if cluster.shape[0] > 1:
+            self.compactness = extreme_distance(cluster, cluster, symmetric=True, memory_limit=self.memory_limit)
         else:
             self.compactness = float('inf')
 
@@ -112,14 +132,12 @@ class Davies_Bouldin:
         self.dispersion = float('inf')
         self.dissimilarity = 0
 
-    # The first parameter of Davies-Bouldin index
-    def dispersion_calculation(self, cluster):
-        dist_sum = 0
-        center = get_center(cluster)
-        for row in cluster:
-            dist = euclidean_distance(row, center)
-            dist_sum += dist
-        self.dispersion = dist_sum / cluster.shape[0]
+    # The first parameter of Davies-Bouldin index, the mean distance between the rows of a cluster and its center
+    def dispersion_calculation(self, cluster, center=None):
+        if center is None:
+            center = get_center(cluster)
+        difference = cluster - center
+        self.dispersion = np.mean(np.sqrt(np.einsum('ij,ij->i', difference, difference)))
 
     # The second parameter of Davies-Bouldin index
     def dissimilarity_calculation(self, cluster1, cluster2):
@@ -127,30 +145,172 @@ class Davies_Bouldin:
         center2 = get_center(cluster2)
         self.dissimilarity = euclidean_distance(center1, center2)
 
-    # Calculating Davies-Bouldin index value
+    # Calculating Davies-Bouldin index value, the centers are computed once and all the ratios
+    # Rij = (Si + Sj) / Dij are made as one matrix
     def Davies_Bouldin_index(self):
-        Rij_values = list()
-        Sn_values = list()
         K = len(self.clusters)
+        if K < 2:
+            return float('inf')
+        centers = np.array([get_center(cluster) for cluster in self.clusters])
+        Sn_values = np.empty(K)
         for i in range(K):
-            self.dispersion_calculation(self.clusters[i])
-            Si = self.dispersion
-            Sn_values.append(Si)
+            self.dispersion_calculation(self.clusters[i], centers[i])
+            Sn_values[i] = self.dispersion
 
-        for i in range(K):
-            Ri_values = list()
-            for j in range(K):
-                if i == j:
-                    continue
-                self.dissimilarity_calculation(self.clusters[i], self.clusters[j])
-                Dij = self.dissimilarity
-                Rij = (Sn_values[i] + Sn_values[j]) / Dij
-                Rij_values.append(Rij)
-            if Rij_values:
-                Ri = max(Rij_values)
-                Ri_values.append(Ri)
-        if Ri_values:
-            DB_value = sum(Ri_values) / K
-            return DB_value
+        difference = centers[:, np.newaxis, :] - centers[np.newaxis, :, :]
+        D = np.sqrt(np.einsum('ijk,ijk->ij', difference, difference))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R = (Sn_values[:, np.newaxis] + Sn_values[np.newaxis, :]) / D
+        np.fill_diagonal(R, -np.inf)
+        DB_value = np.sum(np.max(R, axis=1)) / K
+        return DB_value
+
+
+#####################################
+# All Indices From One Label Vector #
+#####################################
+# Returns a dict with the requested indices of the clustering of dataset given by an integer label for every row.
+# The centers, sums of squares, dispersions and distances between centers are computed once in blocks of at most
+# memory_limit bytes and shared by all indices, and the rows are sorted by their label once for Dunn's index
+def validity_indices(dataset, labels, indices=('RMSSTD', 'Dunn', 'Davies_Bouldin'), K=None,
+                     memory_limit=MEMORY_LIMIT):
+    dataset = np.asarray(dataset, dtype=float)
+    labels = np.asarray(labels, dtype=int)
+    dataset_size, p = dataset.shape
+    if K is None:
+        K = np.max(labels) + 1
+    counts = np.bincount(labels, minlength=K)
+    filled = counts > 0
+    centers = np.full((K, p), np.nan)
+    for i in range(p):
+        centers[filled, i] = np.bincount(labels, weights=dataset[:, i], minlength=K)[filled] / counts[filled]
+
+    # Sums of squares and sums of distances between the rows and their centers
+    SS = np.zeros(K)
+    distance_sums = np.zeros(K)
+    block_size = max(1, memory_limit // (8 * p))
+    for start in range(0, dataset_size, block_size):
+        block_labels = labels[start:start + block_size]
+        difference = dataset[start:start + block_size] - centers[block_labels]
+        square_distance = np.einsum('ij,ij->i', difference, difference)
+        SS += np.bincount(block_labels, weights=square_distance, minlength=K)
+        distance_sums += np.bincount(block_labels, weights=np.sqrt(square_distance), minlength=K)
+
+    values = dict()
+    for index in indices:
+        if index == 'RMSSTD':
+            values[index] = np.sqrt(np.sum(SS) / (p * (dataset_size - K)))
+        elif index == 'Dunn':
+            # An empty cluster has no separability and a cluster with one row has no compactness
+            Dunn_value = 0.0
+            if K > 1 and np.all(counts > 1):
+                order = np.argsort(labels, kind='stable')
+                bounds = np.concatenate(([0], np.cumsum(counts)))
+                clusters = [dataset[order[bounds[i]:bounds[i + 1]]] for i in range(K)]
+                separability = min(extreme_distance(clusters[i], clusters[j], memory_limit=memory_limit)
+                                   for i in range(K) for j in range(i + 1, K))
+                compactness = max(extreme_distance(cluster, cluster, symmetric=True, memory_limit=memory_limit)
+                                  for cluster in clusters)
+                Dunn_value = separability / compactness
+            values[index] = Dunn_value
+        elif index == 'Davies_Bouldin':
+            # Empty clusters have no center and are left out
+            Sn_values = distance_sums[filled] / counts[filled]
+            if Sn_values.shape[0] < 2:
+                values[index] = float('inf')
+                continue
+            difference = centers[filled, np.newaxis, :] - centers[np.newaxis, filled, :]
+            D = np.sqrt(np.einsum('ijk,ijk->ij', difference, difference))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                R = (Sn_values[:, np.newaxis] + Sn_values[np.newaxis, :]) / D
+            np.fill_diagonal(R, -np.inf)
+            values[index] = np.sum(np.max(R, axis=1)) / Sn_values.shape[0]
         else:
+            raise ValueError("Unknown clustering validity index: {}".format(index))
+    return values
+
+
+###################################
+# Incremental RMSSTD And DB Index #
+###################################
+# Keeps the count, sum of rows and sum of squared row norms of every cluster, so a row that moves between clusters
+# updates them in O(p). An object is a K-means callback that is called as tracker(iteration, labels) and appends
+# a dict of the iteration, 'RMSSTD' and 'Davies_Bouldin_RMS' to history. Davies_Bouldin_RMS uses the root mean
+# square distance to the center as dispersion, since the mean distance of Davies_Bouldin can not be kept from
+# these sums, so its values differ from the Davies-Bouldin index
+class IncrementalIndices:
+    def __init__(self, dataset, K):
+        # The rows are centered once, the sums of squares lose their precision on data far from the origin
+        dataset = np.asarray(dataset, dtype=float)
+        self.dataset = dataset - np.mean(dataset, axis=0)
+        self.K = K
+        self.counts = np.zeros(K)
+        self.sums = np.zeros((K, self.dataset.shape[1]))
+        self.squares = np.zeros(K)
+        self.labels = None
+        self.history = list()
+
+    # Sets the sums of all clusters from a label for every row
+    def assign(self, labels):
+        self.labels = np.array(labels, dtype=int)
+        self.counts = np.bincount(self.labels, minlength=self.K).astype(float)
+        for i in range(self.dataset.shape[1]):
+            self.sums[:, i] = np.bincount(self.labels, weights=self.dataset[:, i], minlength=self.K)
+        self.squares = np.bincount(self.labels, weights=np.einsum('ij,ij->i', self.dataset, self.dataset),
+                                   minlength=self.K)
+
+    # Moves the row with index row from cluster source to cluster target
+    def move(self, row, source, target):
+        values = self.dataset[row]
+        square = np.dot(values, values)
+        self.counts[source] -= 1
+        self.sums[source] -= values
+        self.squares[source] -= square
+        self.counts[target] += 1
+        self.sums[target] += values
+        self.squares[target] += square
+        self.labels[row] = target
+
+    # Returns the sum of squares of every cluster
+    def sum_of_squares(self):
+        filled = self.counts > 0
+        SS = np.zeros(self.K)
+        SS[filled] = self.squares[filled] - np.einsum('ij,ij->i', self.sums[filled], self.sums[filled]) / \
+            self.counts[filled]
+        return np.maximum(SS, 0)
+
+    def RMSSTD_index(self):
+        return np.sqrt(np.sum(self.sum_of_squares()) / (self.dataset.shape[1] * (self.dataset.shape[0] - self.K)))
+
+    def Davies_Bouldin_RMS_index(self):
+        filled = self.counts > 0
+        if np.sum(filled) < 2:
             return float('inf')
+        centers = self.sums[filled] / self.counts[filled, np.newaxis]
+        Sn_values = np.sqrt(self.sum_of_squares()[filled] / self.counts[filled])
+        difference = centers[:, np.newaxis, :] - centers[np.newaxis, :, :]
+        D = np.sqrt(np.einsum('ijk,ijk->ij', difference, difference))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R = (Sn_values[:, np.newaxis] + Sn_values[np.newaxis, :]) / D
+        np.fill_diagonal(R, -np.inf)
+        return np.sum(np.max(R, axis=1)) / centers.shape[0]
+
+    # Updates the sums with the rows whose label changed since the last call and records the indices
+    def __call__(self, iteration, labels):
+        if self.labels is None:
+            self.assign(labels)
+        else:
+            moved = np.flatnonzero(labels != self.labels)
+            if moved.shape[0] > 0:
+                source, target = self.labels[moved], np.asarray(labels[moved], dtype=int)
+                rows = self.dataset[moved]
+                squares = np.einsum('ij,ij->i', rows, rows)
+                np.subtract.at(self.counts, source, 1)
+                np.add.at(self.counts, target, 1)
+                np.subtract.at(self.sums, source, rows)
+                np.add.at(self.sums, target, rows)
+                np.subtract.at(self.squares, source, squares)
+                np.add.at(self.squares, target, squares)
+                self.labels[moved] = target
+        self.history.append({'iteration': iteration, 'RMSSTD': self.RMSSTD_index(),
+                             'Davies_Bouldin_RMS': self.Davies_Bouldin_RMS_index()})
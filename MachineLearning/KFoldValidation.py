@@ -0,0 +1,33 @@
+import numpy as np
+from multiprocessing import Pool
+from SharedArrays import SharedArray, attach_worker, worker_arrays
+
+
+# Returns the row numbers of the k folds, they only depend on seed
+def split_folds(data_size, k, seed):
+    permutation = np.random.RandomState(seed).permutation(data_size)
+    return np.array_split(permutation, k)
+
+
+# Trains a model on all folds except one and returns its accuracy on that fold
+def run_fold(job):
+    build_model, fold, k, seed = job
+    dataset = worker_arrays['dataset']
+    folds = split_folds(dataset.shape[0], k, seed)
+    validation_data = dataset[folds[fold]]
+    train_data = dataset[np.concatenate(folds[:fold] + folds[fold + 1:])]
+
+    # Every fold has its own seed, so the results do not depend on which worker runs it
+    np.random.seed(seed + fold + 1)
+    model = build_model(train_data)
+    return model.calculate_performance(validation_data[:, :-1], validation_data[:, -1])
+
+
+# Runs the k folds of a K fold validation in a process pool and returns the accuracy of every fold.
+# build_model gets the train data of a fold and returns a trained model with calculate_performance(),
+# it has to be picklable, e.g. a module level function or a functools.partial of one
+def parallel_K_fold_validation(build_model, train_data, k=5, seed=1, processes=None):
+    with SharedArray(train_data) as shared_data:
+        with Pool(processes or k, initializer=attach_worker, initargs=({'dataset': shared_data.spec},)) as pool:
+            accuracy_list = pool.map(run_fold, [(build_model, fold, k, seed) for fold in range(k)])
+    return accuracy_list
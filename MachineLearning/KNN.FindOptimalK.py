@@ -1,4 +1,5 @@
 import numpy as np
+from KNearestNeighbor import predict_many, distance_blocks, nearest_rows, MEMORY_LIMIT
 from os import path
 
 
@@ -34,35 +35,53 @@ def predict_classification(train, test_row, k_neighbors):
 
 # We can calculate the algorithm accuracy with having real outputs
 def calculate_accuracy(train, test_in, test_out, k_neighbor):
-    correct = 0.0
-    for i in range(test_in.shape[0]):
-        prediction = predict_classification(train, test_in[i], k_neighbor)
-        real_value = test_out[i]
-        if real_value == prediction:
-            correct += 1.0
-    accuracy = correct / test_in.shape[0]
+    predictions = predict_many(train, test_in, k_neighbor)
+    accuracy = np.count_nonzero(predictions == test_out) / test_in.shape[0]
     return accuracy
 
 
+# Returns a list of (k, accuracy) for every k in k_values. The neighbors of each test row are ordered
+# only once, and the votes for every k are read from the prefix counts of that single ordering
+def sweep_K(train, test_in, test_out, k_values, memory_limit=MEMORY_LIMIT):
+    train_in = train[:, :-1]
+    train_out = train[:, -1]
+    classes = np.unique(train_out)
+    test_in = np.asarray(test_in, dtype=float)
+    max_k = max(k_values)
+    k_index = np.array(k_values) - 1
+    correct = np.zeros(len(k_values))
+    for start, end, distances in distance_blocks(train_in, test_in, memory_limit):
+        # The max_k nearest neighbors of each row ordered by distance
+        neighbor_labels = train_out[nearest_rows(distances, max_k, train_in, test_in[start:end])]
+
+        # votes[i, j, c] is the number of class c labels among the k_values[j] nearest neighbors of row i
+        votes = np.cumsum(neighbor_labels[:, :, np.newaxis] == classes, axis=1, dtype=np.int32)[:, k_index]
+        predictions = classes[np.argmax(votes, axis=2)]
+
+        # A tie is broken by the same expression as in predict_classification()
+        tied = np.count_nonzero(votes == np.max(votes, axis=2)[:, :, np.newaxis], axis=2) > 1
+        for i, j in zip(*np.nonzero(tied)):
+            output_values = list(neighbor_labels[i, :k_values[j]])
+            predictions[i, j] = max(set(output_values), key=output_values.count)
+        correct += np.count_nonzero(predictions == test_out[start:end, np.newaxis], axis=0)
+    accuracies = correct / test_in.shape[0]
+    return list(zip(k_values, accuracies))
+
+
 # Finding optimal K with validation technique
 def find_optimal_K(train_data):
     results = list()
-    for i in range(train_data.shape[0] // 10):
-        train_data_clone = train_data
-        data_size = train_data_clone.shape
-        validation_size = data_size[0] // 10, data_size[1]
-        validation_data = np.zeros(validation_size)
-        K_range = np.ceil(np.log10(data_size[0])) * 10
-        np.random.seed(1)
-        for j in range(validation_size[0]):
-            index = np.random.randint(data_size[0])
-            validation_data[j, :] = train_data_clone[index]
-            train_data_clone = np.delete(train_data_clone, index, 0)
-            data_size = train_data_clone.shape
-        k_values = [i for i in range(1, int(K_range))]
-        for k in k_values:
-            accuracy = calculate_accuracy(train_data_clone, validation_data[:, :-1], validation_data[:, -1], k)
-            results.append((k, accuracy))
+    data_size = train_data.shape[0]
+    validation_size = data_size // 10
+    K_range = np.ceil(np.log10(data_size)) * 10
+    k_values = [i for i in range(1, int(K_range))]
+    random_state = np.random.RandomState(1)
+    for i in range(data_size // 10):
+        # The validation rows are the head of a random permutation, the rest is used for training
+        permutation = random_state.permutation(data_size)
+        validation_data = train_data[permutation[:validation_size]]
+        train_data_clone = train_data[permutation[validation_size:]]
+        results.extend(sweep_K(train_data_clone, validation_data[:, :-1], validation_data[:, -1], k_values))
     results.sort(key=lambda tup: (-tup[1], tup[0]))
     best_k = results[0][0]
     return best_k
@@ -84,10 +103,11 @@ def main():
 
     k = find_optimal_K(train_data=train_data)
     correct = 0
+    predictions = predict_many(train_data, data_test_in, k)
 
-    # With this loop, we classify all the test dataset row and measure performance
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(len(data_test_out)):
-        prediction = predict_classification(train_data, data_test_in[i], k)
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
@@ -98,9 +118,7 @@ def main():
     performance = correct / len(data_test_out)
     print("\nOptimal K found: {}\n\nAccuracy on test data: {:.2f}%\n".format(k, performance * 100))
     k_values = [i for i in range(1, 30)]
-    accuracies = list()
-    for k in k_values:
-        accuracies.append((k, calculate_accuracy(train_data, data_test_in, data_test_out, k)))
+    accuracies = sweep_K(train_data, data_test_in, data_test_out, k_values)
     accuracies.sort(key=lambda tup: (-tup[1], tup[0]))
     print("The best K for test data is: {}".format(accuracies[0][0]))
 
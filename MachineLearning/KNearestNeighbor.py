@@ -1,8 +1,13 @@
+import heapq
+import time
 import numpy as np
 from os import path
 
 K = 10
 
+# Upper bound in bytes for the query-to-train distance block of the batch predictions
+MEMORY_LIMIT = 256 * 2 ** 20
+
 
 # Is defined for calculating Euclidean distance between two rows of data
 def euclidean_distance(row1, row2):
@@ -13,14 +18,262 @@ def euclidean_distance(row1, row2):
     return distance
 
 
+# Euclidean distance between test_row and every row of a matrix, summed column by column
+# in the same order as euclidean_distance(), so both give bit-identical results
+def rows_distance(rows, test_row):
+    distance = np.zeros(rows.shape[0])
+    for i in range(len(test_row)):
+        distance += (rows[:, i] - test_row[i]) ** 2
+    distance = np.sqrt(distance)
+    return distance
+
+
+# Yields (start, end, distances) where distances holds the squared Euclidean distances between the test
+# rows start..end and every train row. Each block is computed as ||a||^2 + ||b||^2 - 2ab with one matrix
+# product, which is only accurate up to rounding, so the neighbors are chosen from it with nearest_rows().
+# A block has 17 bytes per train row for every test row, the block itself, the partitioned copy and the
+# candidate mask of nearest_rows(), and the number of rows in a block keeps that under memory_limit bytes
+def distance_blocks(train_in, test_matrix, memory_limit=MEMORY_LIMIT):
+    train_norms = np.einsum('ij,ij->i', train_in, train_in)
+    block_size = max(1, memory_limit // (17 * max(1, train_in.shape[0])))
+    for start in range(0, test_matrix.shape[0], block_size):
+        block = test_matrix[start:start + block_size]
+        distances = np.dot(block, train_in.T)
+        distances *= -2
+        distances += train_norms
+        distances += np.einsum('ij,ij->i', block, block)[:, np.newaxis]
+        np.maximum(distances, 0, out=distances)
+        yield start, start + block.shape[0], distances
+
+
+# Returns the indexes of the k nearest rows of train_in for every row of block, ordered by distance and then
+# by row index like the stable sort of predict_classification(). The candidates are the rows whose distance
+# in the matrix product block is within its rounding error of the k-th smallest one. Only their distances are
+# summed again column by column like euclidean_distance(), so ties are decided on the exact distances
+def nearest_rows(distances, k, train_in, block):
+    rows, columns = distances.shape
+    k = min(k, columns)
+    if k == columns:
+        candidates = np.isfinite(distances)
+    else:
+        kth = np.partition(distances, k - 1, axis=1)[:, k - 1]
+        # The rounding error of ||a||^2 + ||b||^2 - 2ab grows with the norms and the number of columns
+        scale = np.einsum('ij,ij->i', block, block) + np.max(np.einsum('ij,ij->i', train_in, train_in))
+        tolerance = 8 * (train_in.shape[1] + 2) * np.finfo(float).eps * scale
+        candidates = distances <= (kth + tolerance)[:, np.newaxis]
+    row, column = np.nonzero(candidates)
+    exact = np.zeros(row.shape[0])
+    for i in range(train_in.shape[1]):
+        exact += (block[row, i] - train_in[column, i]) ** 2
+    exact = np.sqrt(exact)
+
+    # np.nonzero gives the candidates of a row by increasing row index, and lexsort keeps that order for ties
+    order = np.lexsort((exact, row))
+    counts = np.bincount(row, minlength=rows)
+    rank = np.arange(row.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    return column[order][rank < k].reshape(rows, k)
+
+
+# Returns the majority label of every row of neighbor_labels. A tie is broken by the same expression as in
+# predict_classification(), which is evaluated only for the tied rows
+def majority_vote(neighbor_labels, classes):
+    votes = np.empty((neighbor_labels.shape[0], classes.shape[0]), dtype=int)
+    for c in range(classes.shape[0]):
+        votes[:, c] = np.count_nonzero(neighbor_labels == classes[c], axis=1)
+    predictions = classes[np.argmax(votes, axis=1)]
+    tied = np.count_nonzero(votes == np.max(votes, axis=1)[:, np.newaxis], axis=1) > 1
+    for i in np.flatnonzero(tied):
+        output_values = list(neighbor_labels[i])
+        predictions[i] = max(set(output_values), key=output_values.count)
+    return predictions
+
+
+# Returns the predicted labels of all rows of test_matrix with the K nearest neighbors of train
+def predict_many(train, test_matrix, K, memory_limit=MEMORY_LIMIT):
+    train_in = train[:, :-1]
+    train_out = train[:, -1]
+    classes = np.unique(train_out)
+    test_matrix = np.asarray(test_matrix, dtype=float)
+    predictions = np.empty(test_matrix.shape[0])
+    for start, end, distances in distance_blocks(train_in, test_matrix, memory_limit):
+        nearest = nearest_rows(distances, K, train_in, test_matrix[start:end])
+        predictions[start:end] = majority_vote(train_out[nearest], classes)
+    return predictions
+
+
+class KDTree:
+    # The tree is built once on the input part of the training data (without the label column)
+    def __init__(self, points, leaf_size=40):
+        self.leaf_size = leaf_size
+        # Original row numbers, reordered so that every node owns a contiguous slice
+        self.rows = np.arange(points.shape[0])
+        self.points = np.array(points, dtype=float)
+        # Each node is a list of [start, end, split_dim, split_value, left, right], leaves have split_dim = -1
+        self.nodes = list()
+        # Bounding box of every node, used to prune the search
+        self.lower = list()
+        self.upper = list()
+        self.build(0, self.points.shape[0])
+
+    def build(self, start, end):
+        node = len(self.nodes)
+        node_points = self.points[start:end]
+        self.nodes.append([start, end, -1, 0.0, -1, -1])
+        self.lower.append(node_points.min(axis=0))
+        self.upper.append(node_points.max(axis=0))
+        if end - start <= self.leaf_size:
+            return node
+
+        # Splitting on the median of the dimension with the widest spread
+        split_dim = int(np.argmax(self.upper[node] - self.lower[node]))
+        if self.upper[node][split_dim] == self.lower[node][split_dim]:
+            return node
+        order = np.argsort(node_points[:, split_dim], kind='stable')
+        self.points[start:end] = node_points[order]
+        self.rows[start:end] = self.rows[start:end][order]
+        middle = start + (end - start) // 2
+        split_value = self.points[middle - 1, split_dim]
+
+        left = self.build(start, middle)
+        right = self.build(middle, end)
+        self.nodes[node][2:] = [split_dim, split_value, left, right]
+        return node
+
+    # Distance between test_row and the bounding box of a node, it is never bigger than the
+    # distance to any row inside the node
+    def box_distance(self, node, test_row):
+        distance = 0.0
+        for i in range(len(test_row)):
+            if test_row[i] < self.lower[node][i]:
+                distance += (self.lower[node][i] - test_row[i]) ** 2
+            elif test_row[i] > self.upper[node][i]:
+                distance += (test_row[i] - self.upper[node][i]) ** 2
+        return np.sqrt(distance)
+
+    # Returns the original row numbers of the k nearest rows, ordered by distance and then by row
+    # number, which is the same order as the stable sort of the brute-force search
+    def query(self, test_row, k):
+        # A heap of (-distance, -row) keeps the worst of the k best candidates on top
+        heap = list()
+        self.search(0, test_row, k, heap)
+        neighbors = sorted((-dist, -row) for dist, row in heap)
+        return [row for _, row in neighbors]
+
+    def search(self, node, test_row, k, heap):
+        if len(heap) == k and self.box_distance(node, test_row) > -heap[0][0]:
+            return
+        start, end, split_dim, split_value, left, right = self.nodes[node]
+
+        if split_dim < 0:
+            distances = rows_distance(self.points[start:end], test_row)
+            for dist, row in zip(distances, self.rows[start:end]):
+                candidate = (-dist, -row)
+                if len(heap) < k:
+                    heapq.heappush(heap, candidate)
+                elif candidate > heap[0]:
+                    heapq.heapreplace(heap, candidate)
+            return
+
+        # Visiting the side of the split that contains test_row first
+        if test_row[split_dim] <= split_value:
+            self.search(left, test_row, k, heap)
+            self.search(right, test_row, k, heap)
+        else:
+            self.search(right, test_row, k, heap)
+            self.search(left, test_row, k, heap)
+
+
+# Squared Euclidean distance between test_row and every row of a matrix in one vectorized expression
+def rows_square_distance(rows, test_row):
+    difference = rows - test_row
+    return np.einsum('ij,ij->i', difference, difference)
+
+
+# Exact search used as the reference of the approximate index, returns the k nearest rows ordered
+# by distance and then by row number
+def exact_neighbors(points, test_row, k):
+    distances = rows_square_distance(points, test_row)
+    return np.lexsort((np.arange(points.shape[0]), distances))[:k]
+
+
+class LSHIndex:
+    # Approximate search with Euclidean locality-sensitive hashing. Each of the num_tables hash tables puts a
+    # row in the bucket given by num_projections random projections cut in pieces of bucket_width.
+    # More tables give a better recall, more projections give smaller buckets and faster queries
+    def __init__(self, points, num_tables=10, num_projections=6, bucket_width=None, seed=1):
+        self.points = np.array(points, dtype=float)
+        self.num_tables = num_tables
+        random_state = np.random.RandomState(seed)
+
+        # By default a bucket is half of the spread of the data along a random direction, data without any
+        # spread falls in a single bucket of any width
+        if bucket_width is None:
+            bucket_width = np.sqrt(np.sum(np.var(self.points, axis=0))) / 2
+            if bucket_width == 0:
+                bucket_width = 1.0
+        elif bucket_width <= 0:
+            raise ValueError("bucket_width must be positive: {}".format(bucket_width))
+        self.bucket_width = bucket_width
+        self.projections = random_state.normal(0, 1, (num_tables, self.points.shape[1], num_projections))
+        self.offsets = random_state.uniform(0, bucket_width, (num_tables, num_projections))
+        # The bucket numbers of the projections are mixed into a single integer key
+        self.multipliers = random_state.randint(1, 2 ** 31, num_projections).astype(np.int64)
+
+        # Every table maps a key to the row numbers of its bucket
+        self.tables = list()
+        for t in range(num_tables):
+            keys = self.hash_keys(self.points, t)
+            order = np.argsort(keys, kind='stable')
+            unique_keys, starts = np.unique(keys[order], return_index=True)
+            buckets = np.split(order, starts[1:])
+            self.tables.append(dict(zip(unique_keys.tolist(), buckets)))
+
+    def hash_keys(self, rows, table):
+        buckets = np.floor((np.dot(rows, self.projections[table]) + self.offsets[table]) / self.bucket_width)
+        return np.dot(buckets.astype(np.int64), self.multipliers)
+
+    # Returns the approximate k nearest rows. The candidates of all the buckets of test_row are ranked with
+    # their exact distance, and the search falls back to all rows when the buckets hold fewer than k rows
+    def query(self, test_row, k):
+        test_row = np.asarray(test_row, dtype=float)
+        candidates = list()
+        for t in range(self.num_tables):
+            key = int(self.hash_keys(test_row, t))
+            if key in self.tables[t]:
+                candidates.append(self.tables[t][key])
+        if candidates:
+            candidates = np.unique(np.concatenate(candidates))
+        if len(candidates) < k:
+            return exact_neighbors(self.points, test_row, k)
+        distances = rows_square_distance(self.points[candidates], test_row)
+        return candidates[np.lexsort((candidates, distances))[:k]]
+
+
 class KNN:
-    def __init__(self, train_data, K):
+    # index can be None for the brute-force search, 'kd_tree' for the exact tree search or 'lsh' for the
+    # approximate search, index_params are passed to the index
+    def __init__(self, train_data, K, index=None, **index_params):
         self.K = K
         self.neighbors = None
         self.train_data = train_data
 
+        if index is None:
+            self.index = None
+        elif index == 'kd_tree':
+            self.index = KDTree(train_data[:, :-1], **index_params)
+        elif index == 'lsh':
+            self.index = LSHIndex(train_data[:, :-1], **index_params)
+        else:
+            raise ValueError("Unknown neighbor index: {}".format(index))
+
     # We can classify an input data by the training data with predict_classification() function
     def predict_classification(self, test_row):
+        if self.index is not None:
+            neighbors = self.index.query(test_row, self.K)
+            output_values = [self.train_data[row][-1] for row in neighbors]
+            prediction = max(set(output_values), key=output_values.count)
+            return prediction
+
         # Getting the K nearest neighbors of test_row as a list
         distances = list()
         for row in self.train_data:
@@ -38,17 +291,52 @@ class KNN:
         prediction = max(set(output_values), key=output_values.count)
         return prediction
 
+    # Classifies all rows of test_matrix, at once with blocked matrix operations or with the neighbor index
+    def predict_many(self, test_matrix, memory_limit=MEMORY_LIMIT):
+        if self.index is not None:
+            return np.array([self.predict_classification(test_row) for test_row in test_matrix])
+        return predict_many(self.train_data, test_matrix, self.K, memory_limit)
+
     # We can calculate the algorithm accuracy with having real outputs
     def calculate_accuracy(self, test_in, test_out):
-        correct = 0.0
-        for i in range(test_in.shape[0]):
-            prediction = self.predict_classification(test_in[i])
-            real_value = test_out[i]
-            if real_value == prediction:
-                correct += 1.0
-        accuracy = correct / test_in.shape[0]
+        predictions = self.predict_many(test_in)
+        accuracy = np.count_nonzero(predictions == test_out) / test_in.shape[0]
         return accuracy
 
+    # Measures the index against the exact brute-force search on a sample of test_matrix rows. Returns the
+    # mean recall of the K neighbors, the agreement of the predicted labels and the mean query times
+    def recall_report(self, test_matrix, sample_size=100, seed=1):
+        if self.index is None:
+            raise ValueError("recall_report() needs a KNN built with a neighbor index")
+        random_state = np.random.RandomState(seed)
+        sample = random_state.choice(test_matrix.shape[0], min(sample_size, test_matrix.shape[0]), replace=False)
+        train_in = self.train_data[:, :-1]
+        train_out = self.train_data[:, -1]
+        recall = 0.0
+        agreement = 0
+        index_time = 0.0
+        exact_time = 0.0
+        for row in test_matrix[sample]:
+            start = time.perf_counter()
+            neighbors = self.index.query(row, self.K)
+            index_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            exact = exact_neighbors(train_in, row, self.K)
+            exact_time += time.perf_counter() - start
+
+            recall += np.intersect1d(neighbors, exact).shape[0] / self.K
+            output_values = list(train_out[neighbors])
+            exact_values = list(train_out[exact])
+            if max(set(output_values), key=output_values.count) == max(set(exact_values), key=exact_values.count):
+                agreement += 1
+
+        report = {'recall': recall / sample.shape[0],
+                  'label_agreement': agreement / sample.shape[0],
+                  'index_query_ms': index_time * 1000 / sample.shape[0],
+                  'exact_query_ms': exact_time * 1000 / sample.shape[0]}
+        return report
+
 
 def main():
     # Import train data
@@ -66,9 +354,10 @@ def main():
 
     correct = 0
     knn_algorithm = KNN(train_data, K)
-    # With this loop, we classify all the test dataset row and measure performance
+    predictions = knn_algorithm.predict_many(data_test_in)
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(len(data_test_out)):
-        prediction = knn_algorithm.predict_classification(data_test_in[i])
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}.'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
@@ -79,6 +368,13 @@ def main():
     performance = correct / len(data_test_out)
     print("\nAccuracy on test dataset: {}%".format(performance * 100))
 
+    # Comparing the approximate search with the exact search
+    lsh_knn = KNN(train_data, K, index='lsh', num_tables=10, num_projections=2)
+    report = lsh_knn.recall_report(data_test_in)
+    print("\nLSH recall: {:.2f}, label agreement: {:.2f}%, query time: {:.3f} ms (exact: {:.3f} ms)"
+          .format(report['recall'], report['label_agreement'] * 100, report['index_query_ms'],
+                  report['exact_query_ms']))
+
 
 if __name__ == "__main__":
     main()
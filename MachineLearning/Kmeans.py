@@ -1,6 +1,9 @@
+import os
 import numpy as np
+from multiprocessing import Pool
 from matplotlib import pyplot as plt
-from ClusteringValidityIndices import Dunn, Davies_Bouldin, RMSSTD
+from ClusteringValidityIndices import validity_indices
+from SharedArrays import SharedArray, memmap_spec, attach_worker, worker_arrays
 from os import path
 
 
@@ -13,17 +16,214 @@ def euclidean_distance(row1, row2):
     return distance
 
 
+# Upper bound in bytes for a block of the point-to-center distance matrix
+MEMORY_LIMIT = 256 * 2 ** 20
+
+
+# Returns the squared Euclidean distances between rows and centers as a (rows, centers) matrix
+def square_distances(rows, centers):
+    distances = np.dot(rows, centers.T)
+    distances *= -2
+    distances += np.einsum('ij,ij->i', rows, rows)[:, np.newaxis]
+    distances += np.einsum('ij,ij->i', centers, centers)
+    np.maximum(distances, 0, out=distances)
+    return distances
+
+
+# Assigns every row to its nearest center block by block, a row at the same distance of several centers goes
+# to the last of them like in K_means_loop(). Returns the labels and the distances to the nearest center, and
+# with second=True also the distances to the second nearest center
+def assign_clusters(dataset, centers, second=False, memory_limit=MEMORY_LIMIT):
+    dataset_size = dataset.shape[0]
+    labels = np.empty(dataset_size, dtype=int)
+    nearest = np.empty(dataset_size)
+    second_nearest = np.full(dataset_size, np.inf)
+    block_size = max(1, memory_limit // (8 * centers.shape[0]))
+    for start in range(0, dataset_size, block_size):
+        distances = square_distances(dataset[start:start + block_size], centers)
+        rows = np.arange(distances.shape[0])
+        labels[start:start + block_size] = centers.shape[0] - 1 - np.argmin(distances[:, ::-1], axis=1)
+        nearest[start:start + block_size] = distances[rows, labels[start:start + block_size]]
+        if second and centers.shape[0] > 1:
+            distances[rows, labels[start:start + block_size]] = np.inf
+            second_nearest[start:start + block_size] = np.min(distances, axis=1)
+    if second:
+        return labels, np.sqrt(nearest), np.sqrt(second_nearest)
+    return labels, np.sqrt(nearest)
+
+
+# Returns the sum of the rows of every cluster and the number of rows in it
+def cluster_sums(dataset, labels, K):
+    counts = np.bincount(labels, minlength=K)
+    sums = np.empty((K, dataset.shape[1]))
+    for i in range(dataset.shape[1]):
+        sums[:, i] = np.bincount(labels, weights=dataset[:, i], minlength=K)
+    return sums, counts
+
+
+# Returns K initial centers. init is 'random' for K distinct random rows, 'k-means++' for rows sampled with a
+# probability proportional to their squared distance to the centers chosen before, or an array of centers
+def initial_centers(dataset, K, init='random'):
+    dataset_size = dataset.shape[0]
+    if isinstance(init, str) and init == 'random':
+        indx = np.random.choice(dataset_size, K, replace=False)
+        return np.array(dataset[indx, :], dtype=float)
+    if isinstance(init, str) and init == 'k-means++':
+        centers = np.empty((K, dataset.shape[1]))
+        centers[0] = dataset[np.random.randint(dataset_size)]
+        closest = square_distances(dataset, centers[:1])[:, 0]
+        for i in range(1, K):
+            total = np.sum(closest)
+            if total > 0:
+                indx = min(np.searchsorted(np.cumsum(closest), np.random.uniform(0, total)), dataset_size - 1)
+            else:
+                indx = np.random.randint(dataset_size)
+            centers[i] = dataset[indx]
+            np.minimum(closest, square_distances(dataset, centers[i:i + 1])[:, 0], out=closest)
+        return centers
+    if isinstance(init, str):
+        raise ValueError("Unknown K-means initialization: {}".format(init))
+    return np.array(init, dtype=float)
+
+
 class Kmeans:
     def __init__(self):
         self.centers = None
         self.optimal_k = None
         self.clustered = None
         self.clusters_variance = None
+        self.labels = None
+
+    # method is 'vectorized' for Lloyd iterations with blocked distance matrices, 'hamerly' to skip the
+    # distance computations of rows whose bounds show that their cluster can not change, 'parallel' to assign
+    # shards of the dataset in processes workers, or 'loop' for the row by row implementation. init is passed
+    # to initial_centers(). callback is called as callback(iteration, labels) after every assignment step, the
+    # labels must not be changed by it
+    def K_means(self, dataset, K, method='vectorized', init='random', processes=None, callback=None):
+        if method == 'vectorized':
+            self.K_means_vectorized(dataset, K, init=init, callback=callback)
+        elif method == 'hamerly':
+            self.K_means_vectorized(dataset, K, bounds=True, init=init, callback=callback)
+        elif method == 'parallel':
+            self.parallel_K_means(dataset, K, processes=processes, init=init, callback=callback)
+        elif method == 'loop':
+            self.K_means_loop(dataset, K, init=init, callback=callback)
+        else:
+            raise ValueError("Unknown K-means method: {}".format(method))
 
-    def K_means(self, dataset, K):
+    def K_means_vectorized(self, dataset, K, bounds=False, init='random', callback=None):
         dataset_size = dataset.shape[0]
-        indx = np.random.choice(dataset_size, K, replace=False)
-        self.centers = dataset[indx, :]
+        self.centers = initial_centers(dataset, K, init)
+        error = 1.000
+        iteration = 0
+
+        while error > 0.005:
+            if not bounds or iteration == 0:
+                labels, upper, lower = assign_clusters(dataset, self.centers, second=True)
+            else:
+                # Hamerly's test, a row keeps its cluster when its distance to the center (upper bound) is not
+                # more than the distance to any other center (lower bound) or half the gap to the nearest center.
+                # Rows on the bound are checked, they may tie with a later center
+                center_gap = np.sqrt(square_distances(self.centers, self.centers))
+                np.fill_diagonal(center_gap, np.inf)
+                bound = np.maximum(np.min(center_gap, axis=1)[labels] / 2, lower)
+                check = np.flatnonzero(upper >= bound)
+
+                # Tightening the upper bound of the remaining rows before computing all their distances
+                difference = dataset[check] - self.centers[labels[check]]
+                upper[check] = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+                check = check[upper[check] >= bound[check]]
+                if check.shape[0] > 0:
+                    labels[check], upper[check], lower[check] = assign_clusters(dataset[check], self.centers,
+                                                                                second=True)
+            if callback is not None:
+                callback(iteration, labels)
+
+            # Updating centers, an empty cluster gets a random row as its center
+            sums, counts = cluster_sums(dataset, labels, K)
+            new_centers = np.empty(self.centers.shape)
+            filled = counts > 0
+            new_centers[filled] = sums[filled] / counts[filled, np.newaxis]
+            for i in np.flatnonzero(~filled):
+                new_centers[i] = dataset[np.random.randint(dataset_size)]
+
+            # Calculating distance between new centers and previous centers
+            error_vector = np.sqrt(np.sum((new_centers - self.centers) ** 2, axis=1))
+            error = np.sqrt(np.dot(error_vector, error_vector))
+            if bounds:
+                upper += error_vector[labels]
+                lower -= np.max(error_vector)
+
+            iteration += 1
+            self.centers = new_centers
+
+        # The spread of a cluster is the mean distance between its rows and its center
+        difference = dataset - self.centers[labels]
+        distances = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+        counts = np.bincount(labels, minlength=K)
+        filled = counts > 0
+        self.clusters_variance = np.ones((K, 1))
+        self.clusters_variance[filled, 0] = np.bincount(labels, weights=distances, minlength=K)[filled] / counts[filled]
+        self.labels = labels
+        self.clustered = np.column_stack((dataset, labels))
+
+    # The iterations of K_means_vectorized() with the assignment step split into shards that a process pool
+    # assigns in parallel. The dataset is read by the workers from shared memory, or from its file when it is a
+    # np.memmap, and every worker returns the sums and counts of its shard that are reduced to the new centers.
+    # The labels are kept in shared memory, self.clustered is not built since it would copy the whole dataset
+    def parallel_K_means(self, dataset, K, processes=None, init='random', callback=None):
+        dataset_size = dataset.shape[0]
+        processes = processes or os.cpu_count()
+        self.centers = initial_centers(dataset, K, init)
+        boundaries = np.linspace(0, dataset_size, 4 * processes + 1).astype(int)
+        shards = [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+        error = 1.000
+        iteration = 0
+
+        shared_data = None
+        data_spec = memmap_spec(dataset)
+        if data_spec is None:
+            shared_data = SharedArray(dataset)
+            data_spec = shared_data.spec
+        try:
+            with SharedArray(np.zeros(dataset_size, dtype=int)) as shared_labels:
+                with Pool(processes, initializer=attach_worker,
+                          initargs=({'dataset': data_spec, 'labels': shared_labels.spec},)) as pool:
+                    while error > 0.005:
+                        partials = pool.map(assign_shard, [(start, end, self.centers) for start, end in shards])
+                        sums = np.sum([partial[0] for partial in partials], axis=0)
+                        counts = np.sum([partial[1] for partial in partials], axis=0)
+                        if callback is not None:
+                            callback(iteration, shared_labels.array)
+
+                        # Updating centers, an empty cluster gets a random row as its center
+                        new_centers = np.empty(self.centers.shape)
+                        filled = counts > 0
+                        new_centers[filled] = sums[filled] / counts[filled, np.newaxis]
+                        for i in np.flatnonzero(~filled):
+                            new_centers[i] = dataset[np.random.randint(dataset_size)]
+
+                        # Calculating distance between new centers and previous centers
+                        error_vector = np.sqrt(np.sum((new_centers - self.centers) ** 2, axis=1))
+                        error = np.sqrt(np.dot(error_vector, error_vector))
+                        iteration += 1
+                        self.centers = new_centers
+
+                    # The spread of a cluster is the mean distance between its rows and its center
+                    distance_sums = np.sum(pool.map(shard_spreads, [(start, end, self.centers)
+                                                                    for start, end in shards]), axis=0)
+                self.labels = np.array(shared_labels.array)
+        finally:
+            if shared_data is not None:
+                shared_data.close()
+
+        self.clusters_variance = np.ones((K, 1))
+        self.clusters_variance[filled, 0] = distance_sums[filled] / counts[filled]
+        self.clustered = None
+
+    def K_means_loop(self, dataset, K, init='random', callback=None):
+        dataset_size = dataset.shape[0]
+        self.centers = initial_centers(dataset, K, init)
         new_centers = np.empty(self.centers.shape)
         self.clusters_variance = np.ones((self.centers.shape[0], 1))
         cluster_values = np.empty((dataset_size, 1))
@@ -42,6 +242,8 @@ class Kmeans:
                         cluster_values[i, :] = j
             # Set a cluster to each dataset row
             clustered_dataset = np.column_stack((dataset, cluster_values))
+            if callback is not None:
+                callback(iteration, cluster_values[:, 0].astype(int))
 
             # Updating centers
             for i in range(K):
@@ -68,6 +270,43 @@ class Kmeans:
 
         # print('\n\n', 'The obtained centers are:', '\n\n', np.around(centers, decimals=2))
         self.clustered = clustered_dataset
+        self.labels = cluster_values[:, 0].astype(int)
+
+    # Mini-batch K-means for data that does not fit in memory. data is an array or a np.memmap that is read in
+    # batches of batch_size rows for passes times, or an iterable of chunks that is read once. Every center
+    # moves to the running mean of all rows assigned to it so far, which is a learning rate of 1 / count
+    def mini_batch_K_means(self, data, K, batch_size=1024, passes=1, init='k-means++'):
+        if isinstance(data, np.ndarray):
+            chunks = (data[start:start + batch_size] for _ in range(passes)
+                      for start in range(0, data.shape[0], batch_size))
+        else:
+            chunks = iter(data)
+
+        self.centers = None
+        counts = np.zeros(K)
+        distance_sums = np.zeros(K)
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=float)
+            if self.centers is None:
+                self.centers = initial_centers(chunk, K, init)
+            labels, distances = assign_clusters(chunk, self.centers)
+            sums, chunk_counts = cluster_sums(chunk, labels, K)
+            counts += chunk_counts
+            filled = chunk_counts > 0
+            self.centers[filled] += (sums[filled] - chunk_counts[filled, np.newaxis] * self.centers[filled]) / \
+                counts[filled, np.newaxis]
+            distance_sums += np.bincount(labels, weights=distances, minlength=K)
+
+        # The spreads are the mean distances of the rows to their center when they were assigned
+        filled = counts > 0
+        self.clusters_variance = np.ones((K, 1))
+        self.clusters_variance[filled, 0] = distance_sums[filled] / counts[filled]
+        self.labels = None
+        self.clustered = None
+
+    # Returns the nearest center of every row of dataset
+    def predict_clusters(self, dataset):
+        return assign_clusters(dataset, self.centers)[0]
 
     def find_optimal_K(self, input_dataset, max_K=10, iteration=30):
         K_values = list()
@@ -75,17 +314,9 @@ class Kmeans:
             RMSSTD_values = list()
             for K in range(1, max_K):
                 self.K_means(input_dataset, K)
-                clustered = self.clustered
-
-                # Creating a list of clusters for CVI functions input
-                clusters_list = list()
-                for c in range(K):
-                    cluster = clustered[np.where(clustered[:, -1] == c)]
-                    clusters_list.append(cluster)
 
                 # Getting RMSSTD index value
-                cvi = RMSSTD(clusters_list)
-                rmsstd = cvi.RMDDTD_index()
+                rmsstd = validity_indices(input_dataset, self.labels, ('RMSSTD',), K)['RMSSTD']
                 RMSSTD_values.append(rmsstd)
 
             for i in range(1, len(RMSSTD_values)):
@@ -103,6 +334,97 @@ class Kmeans:
 
         return max(set(K_values), key=K_values.count)
 
+    # Model selection with the same RMSSTD elbow rule as find_optimal_K(), the repetitions run in a process pool
+    # that reads the dataset from shared memory. By default every (repetition, K) pair is a job that starts
+    # from random centers like find_optimal_K(). With warm_start every repetition is one job where K + 1 starts
+    # from the solution of K with its worst cluster split, this gives lower RMSSTD curves which can move the
+    # elbow to a larger K. Returns the optimal K, the RMSSTD curve of every repetition as an
+    # (iteration, max_K - 1) array and the fitted models by (repetition, K). The jobs already run in worker
+    # processes, so method can not be 'parallel'
+    def select_K(self, input_dataset, max_K=10, iteration=30, processes=None, warm_start=False, seed=1,
+                 method='vectorized'):
+        if method == 'parallel':
+            raise ValueError("select_K() runs its jobs in a process pool, use method 'vectorized' or 'hamerly'")
+        K_range = list(range(1, max_K))
+        if warm_start:
+            jobs = [(repetition, K_range, True, seed, method) for repetition in range(iteration)]
+        else:
+            jobs = [(repetition, [K], False, seed, method) for repetition in range(iteration) for K in K_range]
+
+        with SharedArray(input_dataset) as shared_data:
+            with Pool(processes or os.cpu_count(), initializer=attach_worker,
+                      initargs=({'dataset': shared_data.spec},)) as pool:
+                job_results = pool.map(selection_job, jobs)
+
+        curves = np.empty((iteration, len(K_range)))
+        models = dict()
+        for repetition, results in job_results:
+            for K, rmsstd, centers, spreads in results:
+                curves[repetition, K - 1] = rmsstd
+                model = Kmeans()
+                model.centers = centers
+                model.clusters_variance = spreads
+                models[(repetition, K)] = model
+
+        K_values = [elbow_K(curve) for curve in curves]
+        self.optimal_k = max(set(K_values), key=K_values.count)
+        return {'optimal_K': self.optimal_k, 'curves': curves, 'models': models}
+
+
+# Returns the first K where the RMSSTD decrease becomes small, or the largest K when it never does
+def elbow_K(RMSSTD_values):
+    for i in range(1, len(RMSSTD_values)):
+        if RMSSTD_values[i-1]/RMSSTD_values[i] <= 1.1:
+            return i
+    return len(RMSSTD_values)
+
+
+# Returns the initial centers of K + 1 clusters from a fitted K clustering, the row of the cluster with the
+# largest sum of squares that is farthest from its center becomes a new center
+def split_worst_cluster(dataset, kmeans):
+    difference = dataset - kmeans.centers[kmeans.labels]
+    square_distance = np.einsum('ij,ij->i', difference, difference)
+    worst = np.argmax(np.bincount(kmeans.labels, weights=square_distance, minlength=kmeans.centers.shape[0]))
+    farthest = np.argmax(np.where(kmeans.labels == worst, square_distance, -1))
+    return np.vstack((kmeans.centers, dataset[farthest]))
+
+
+# Assigns the rows start..end of the shared dataset to their nearest centers, writes their labels to the
+# shared labels and returns the sums and counts of the shard for every center
+def assign_shard(job):
+    start, end, centers = job
+    shard = worker_arrays['dataset'][start:end]
+    labels = assign_clusters(shard, centers)[0]
+    worker_arrays['labels'][start:end] = labels
+    return cluster_sums(shard, labels, centers.shape[0])
+
+
+# Returns the sum of the distances between the rows start..end of the shared dataset and their centers
+def shard_spreads(job):
+    start, end, centers = job
+    labels = worker_arrays['labels'][start:end]
+    difference = worker_arrays['dataset'][start:end] - centers[labels]
+    distances = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+    return np.bincount(labels, weights=distances, minlength=centers.shape[0])
+
+
+# Clusters the shared dataset for every K of a job and returns (K, RMSSTD, centers, spreads) for each of them.
+# Every K has its own seed, so the results do not depend on which worker runs the job
+def selection_job(job):
+    repetition, K_values, warm_start, seed, method = job
+    dataset = worker_arrays['dataset']
+    kmeans = Kmeans()
+    results = list()
+    for K in K_values:
+        np.random.seed([seed, repetition, K])
+        init = 'random'
+        if warm_start and results:
+            init = split_worst_cluster(dataset, kmeans)
+        kmeans.K_means(dataset, K, method=method, init=init)
+        rmsstd = validity_indices(dataset, kmeans.labels, ('RMSSTD',), K)['RMSSTD']
+        results.append((K, rmsstd, kmeans.centers, kmeans.clusters_variance))
+    return repetition, results
+
 
 def main():
     # import iris data and clustering
@@ -116,21 +438,10 @@ def main():
     kmeans.K_means(input_data, k)
     iris_clustered = kmeans.clustered
 
-    # Creating a list of clusters for CVI functions input
-    clusters_list = list()
-    for c in range(k):
-        cluster = iris_clustered[np.where(iris_clustered[:, -1] == c)]
-        clusters_list.append(cluster)
-
-    # Getting Dunn's index value
-    cvi = Dunn(clusters_list)
-    Dunn_value = cvi.Dun_index()
-    print('\n\n', "Dunn's Index = {:.2f}".format(Dunn_value), sep='')
-
-    # Getting Davies-Bouldin index value
-    cvi = Davies_Bouldin(clusters_list)
-    DB_value = cvi.Davies_Bouldin_index()
-    print("Davies-Bouldin Index = {:.2f}".format(DB_value))
+    # Getting Dunn's and Davies-Bouldin index values
+    cvi = validity_indices(input_data, kmeans.labels, ('Dunn', 'Davies_Bouldin'), k)
+    print('\n\n', "Dunn's Index = {:.2f}".format(cvi['Dunn']), sep='')
+    print("Davies-Bouldin Index = {:.2f}".format(cvi['Davies_Bouldin']))
 
     # Visualization of clustering result
     fig = plt.figure(figsize=(8, 6))
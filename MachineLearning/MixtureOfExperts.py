@@ -8,90 +8,114 @@ def sigmoid(x):
 
 
 class MOE:
-    def __init__(self, num_experts=3, lr_expert=0.01, lr_gate=0.01, epoch=500):
-        # Initialization parameters
-        self.input_dimension = 4
+    def __init__(self, num_experts=3, lr_expert=0.01, lr_gate=0.01, epoch=500, batch_size=1):
+        # Initialization parameters, the input dimension and the number of classes come from the training data
+        self.input_dimension = None
         self.input_norm = None
-        self.num_class = 3
+        self.num_class = None
         self.epoch = epoch
         self.lr_expert = lr_expert
         self.lr_gate = lr_gate
         self.num_experts = num_experts
-        # Setting weights for experts and gating network
+        # The updates of the rows of a batch are summed, batch_size=1 updates the weights after every row
+        self.batch_size = batch_size
+        self.experts_weights = None
+        self.gate_weights = None
+        self.experts_biases = None
+
+    # Setting weights for experts and gating network
+    def initialize_weights(self, input_dimension, num_class):
+        self.input_dimension = input_dimension
+        self.num_class = num_class
         self.experts_weights = np.random.normal(0, 1, (self.num_experts, self.num_class, self.input_dimension))
         self.gate_weights = np.random.normal(0, 1, (self.num_experts, self.input_dimension))
         self.experts_biases = np.random.normal(0, 1, (self.num_experts, self.num_class))
-        # Defining other matrix
-        self.output = np.zeros((self.num_experts, self.num_class))
-        self.error = np.empty((self.num_experts, self.num_class))
-        self.gate_output = np.zeros(self.num_experts)
-        self.gate = np.zeros(self.num_experts)
+
+    # Returns the outputs of all experts as (rows, experts, classes) and the soft max of the gating network
+    # outputs as (rows, experts) for normalized input rows
+    def forward(self, input_matrix):
+        output = sigmoid(np.einsum('eci,bi->bec', self.experts_weights, input_matrix) + self.experts_biases)
+        return output, self.gating(input_matrix)
+
+    # Soft max of the gating network outputs as (rows, experts)
+    def gating(self, input_matrix):
+        gate_output = np.dot(input_matrix, self.gate_weights.T)
+        gate = np.exp(gate_output - np.max(gate_output, axis=1, keepdims=True))
+        gate /= np.sum(gate, axis=1, keepdims=True)
+        return gate
+
+    # Combined output of the top_k experts with the highest gate values of every row, their gate values are
+    # renormalized to sum to one. Every expert only evaluates the rows that selected it
+    def sparse_output(self, input_matrix, top_k):
+        gate = self.gating(input_matrix)
+        selected = np.argpartition(-gate, top_k - 1, axis=1)[:, :top_k]
+        selected_gate = np.take_along_axis(gate, selected, axis=1)
+        selected_gate /= np.sum(selected_gate, axis=1, keepdims=True)
+
+        total_output = np.zeros((input_matrix.shape[0], self.num_class))
+        for i in range(self.num_experts):
+            rows, slots = np.nonzero(selected == i)
+            if rows.shape[0] == 0:
+                continue
+            output = sigmoid(np.dot(input_matrix[rows], self.experts_weights[i].T) + self.experts_biases[i])
+            total_output[rows] += selected_gate[rows, slots, np.newaxis] * output
+        return total_output
 
     def train(self, input_data, output_data):
         data_size = len(output_data)
         # Normalization of input data
         self.input_norm = np.linalg.norm(input_data)
-        input_data /= self.input_norm
+        input_data = input_data / self.input_norm
+        self.initialize_weights(input_data.shape[1], int(np.max(output_data)) + 1)
 
         # Creating output vector from output label
-        desired_output = np.empty((data_size, self.num_class))
-        for i in range(data_size):
-            output_row = np.zeros(self.num_class)
-            output_row[int(output_data[i])] = 1
-            desired_output[i] = output_row
+        desired_output = np.zeros((data_size, self.num_class))
+        desired_output[np.arange(data_size), output_data.astype(int)] = 1
 
         for epoch in range(self.epoch):
-            for row in range(data_size):
-                # Getting experts outputs and gating network outputs
-                for i in range(self.num_experts):
-                    self.output[i] = sigmoid(np.dot(self.experts_weights[i], input_data[row]) + self.experts_biases[i])
-                    self.gate_output[i] = np.dot(input_data[row], self.gate_weights[i])
-
-                # Applying soft max function on gating network outputs
-                gate_summation = np.sum(np.array([np.exp(self.gate_output[j]) for j in range(self.num_experts)]))
-                for i in range(self.num_experts):
-                    self.gate[i] = np.exp(self.gate_output[i]) / gate_summation
-
-                    # Calculating error for i-th expert
-                    self.error[i] = np.subtract(desired_output[row], self.output[i])
-
-                h = np.empty(self.gate.shape)
-                errors_summation = np.sum(np.array([self.gate[j] * np.exp(-0.5 * np.dot(self.error[j].T, self.error[j]))
-                                                    for j in range(self.num_experts)]))
-
-                # Updating experts weights and gating network weights
-                for i in range(self.num_experts):
-                    h[i] = self.gate[i] * (-0.5 * np.dot(self.error[i].T, self.error[i])) / errors_summation
-
-                    # Getting delta weights and delta biases for experts
-                    delta_ew = self.lr_expert * h[i] * np.dot(np.reshape(self.error[i], (3, 1)),
-                                                              np.reshape(input_data[row], (1, 4)))
-                    delta_eb = self.lr_expert * h[i] * self.error[i]
-
-                    # The expert with lower error gets more weight in gating network
-                    delta_gw = self.lr_gate * (h[i] - self.gate[i]) * input_data[row]
-
-                    self.experts_weights[i] += delta_ew
-                    self.gate_weights[i] += delta_gw
-                    self.experts_biases[i] += delta_eb
+            for start in range(0, data_size, self.batch_size):
+                batch = input_data[start:start + self.batch_size]
+                output, gate = self.forward(batch)
+
+                # Calculating error of every expert
+                error = desired_output[start:start + self.batch_size, np.newaxis, :] - output
+                squared_error = -0.5 * np.einsum('bec,bec->be', error, error)
+                errors_summation = np.sum(gate * np.exp(squared_error), axis=1, keepdims=True)
+                h = gate * squared_error / errors_summation
+
+                # Updating experts weights and gating network weights,
+                # the expert with lower error gets more weight in gating network
+                self.experts_weights += self.lr_expert * np.einsum('bec,bi->eci', h[:, :, np.newaxis] * error, batch)
+                self.experts_biases += self.lr_expert * np.einsum('be,bec->ec', h, error)
+                self.gate_weights += self.lr_gate * np.dot((h - gate).T, batch)
+
+    # Predict output values for all rows of input_matrix, with top_k only the top_k experts of every row
+    # are evaluated instead of all experts
+    def predict_many(self, input_matrix, top_k=None):
+        normalized_input = np.atleast_2d(input_matrix) / self.input_norm
+        if top_k is None or top_k >= self.num_experts:
+            output, gate = self.forward(normalized_input)
+            total_output = np.einsum('be,bec->bc', gate, output)
+        else:
+            total_output = self.sparse_output(normalized_input, top_k)
+        total_output = np.round(total_output) == 1
+        return np.where(np.any(total_output, axis=1), np.argmax(total_output, axis=1), 0)
 
     # Predict output value for input vector
-    def predict_classification(self, input_vector):
-        normalized_input_vector = input_vector / self.input_norm
-
-        for i in range(self.num_experts):
-            self.output[i] = sigmoid(np.dot(self.experts_weights[i], normalized_input_vector) + self.experts_biases[i])
-            self.gate_output[i] = np.dot(normalized_input_vector, self.gate_weights[i])
-
-        gate_summation = np.sum(np.array([np.exp(self.gate_output[j]) for j in range(self.num_experts)]))
-        for i in range(self.num_experts):
-            self.gate[i] = np.exp(self.gate_output[i]) / gate_summation
-
-        total_output = list(map(round, np.dot(self.gate, self.output)))
-        for output in total_output:
-            if output == 1:
-                return total_output.index(output)
-        return 0
+    def predict_classification(self, input_vector, top_k=None):
+        return int(self.predict_many(input_vector, top_k)[0])
+
+    # Compares the sparse top_k gating with the dense gating on a test dataset
+    def gating_report(self, test_in, test_out, top_k):
+        dense_predictions = self.predict_many(test_in)
+        sparse_predictions = self.predict_many(test_in, top_k)
+        dense_accuracy = np.count_nonzero(dense_predictions == test_out) / test_out.shape[0]
+        sparse_accuracy = np.count_nonzero(sparse_predictions == test_out) / test_out.shape[0]
+        report = {'dense_accuracy': dense_accuracy,
+                  'sparse_accuracy': sparse_accuracy,
+                  'accuracy_change': sparse_accuracy - dense_accuracy,
+                  'agreement': np.count_nonzero(sparse_predictions == dense_predictions) / test_out.shape[0]}
+        return report
 
 
 def main():
@@ -125,6 +149,13 @@ def main():
     performance = correct / output_test_data.shape[0]
     print("\nAccuracy on test dataset: {:.2f}%".format(performance * 100))
 
+    # Accuracy change of the sparse gating that only evaluates the best experts of every input
+    for top_k in range(1, moe.num_experts):
+        report = moe.gating_report(input_test_data, output_test_data, top_k)
+        print("Top {} experts: accuracy {:.2f}% ({:+.2f}%), agreement with dense gating {:.2f}%"
+              .format(top_k, report['sparse_accuracy'] * 100, report['accuracy_change'] * 100,
+                      report['agreement'] * 100))
+
 
 if __name__ == "__main__":
     main()
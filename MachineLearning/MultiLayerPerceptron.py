@@ -1,10 +1,19 @@
+import os
+import struct
+import time
+import zipfile
 import numpy as np
+from functools import partial
+from multiprocessing import Pool
+from KFoldValidation import parallel_K_fold_validation
+from SharedArrays import SharedArray, attach_worker, worker_arrays
 from os import path
 
 
 class MLP:
 
-    def __init__(self, num_input=4, hidden_layers=None, num_output=3, learning_rate=0.01, epoch=1000):
+    def __init__(self, num_input=4, hidden_layers=None, num_output=3, learning_rate=0.01, epoch=1000, batch_size=None,
+                 parameters=None, parallel=None, processes=None, sync_every=1):
 
         # hidden_layers is a list that contains number of neurons in each layer
         if hidden_layers is None:
@@ -15,17 +24,62 @@ class MLP:
         self.num_output = num_output
         self.learning_rate = learning_rate
         self.epoch = epoch
+        # With batch_size the network is trained on mini-batches instead of one row at a time
+        self.batch_size = batch_size
+        # parallel can be None, 'hogwild' or 'averaging' to train on shards of the data in processes workers.
+        # With 'averaging' the workers parameters are averaged every sync_every epochs
+        if parallel not in (None, 'hogwild', 'averaging'):
+            raise ValueError("Unknown parallel training mode: {}".format(parallel))
+        self.parallel = parallel
+        self.processes = processes
+        self.sync_every = sync_every
 
         # Set weights and biases for input data, hidden layers
         layers = [num_input] + hidden_layers + [num_output]
-        weights = list()
-        biases = list()
-        for i in range(len(layers) - 1):
-            # np.random.seed(1)
-            weights.append(np.random.normal(0, 1, (layers[i], layers[i + 1])))
-            biases.append(np.random.normal(0, 1, (1, layers[i + 1])))
-        self.weights = weights
-        self.biases = biases
+        self.layers = layers
+        if parameters is None:
+            weights = list()
+            biases = list()
+            for i in range(len(layers) - 1):
+                # np.random.seed(1)
+                weights.append(np.random.normal(0, 1, (layers[i], layers[i + 1])))
+                biases.append(np.random.normal(0, 1, (1, layers[i + 1])))
+            parameters = np.concatenate([array.ravel() for pair in zip(weights, biases) for array in pair])
+        self.set_parameters(parameters)
+
+    # All weights and biases are views of one flat vector of parameters, so the network can be saved,
+    # loaded or shared as a single array
+    def set_parameters(self, parameters):
+        self.parameters = parameters
+        self.weights = list()
+        self.biases = list()
+        position = 0
+        for i in range(len(self.layers) - 1):
+            size = self.layers[i] * self.layers[i + 1]
+            self.weights.append(parameters[position:position + size].reshape(self.layers[i], self.layers[i + 1]))
+            position += size
+            self.biases.append(parameters[position:position + self.layers[i + 1]].reshape(1, self.layers[i + 1]))
+            position += self.layers[i + 1]
+
+    # Saves the trained network in an uncompressed .npz file
+    def save(self, file_path):
+        np.savez(file_path, layers=np.array(self.layers), learning_rate=self.learning_rate, epoch=self.epoch,
+                 batch_size=self.batch_size or 0, parameters=self.parameters)
+
+    # Loads a network saved by save(). With mmap_mode 'r' (read only) or 'c' (copy on write) the parameters
+    # are memory-mapped from the file instead of being read
+    @classmethod
+    def load(cls, file_path, mmap_mode=None):
+        with np.load(file_path) as data:
+            layers = data['layers'].tolist()
+            learning_rate = float(data['learning_rate'])
+            epoch = int(data['epoch'])
+            batch_size = int(data['batch_size']) or None
+            if mmap_mode is None:
+                parameters = data['parameters']
+            else:
+                parameters = memmap_npz_array(file_path, 'parameters', mmap_mode)
+        return cls(layers[0], layers[1:-1], layers[-1], learning_rate, epoch, batch_size, parameters)
 
     # Activation function
     @staticmethod
@@ -93,29 +147,154 @@ class MLP:
             self.biases[layer] += delta_biases
 
     # train function gets optimal weights and biases matrix with train data
-    def train(self, train_input, train_output):
+    # callback(epoch, mlp) is called after every epoch, or after every averaging round in parallel training
+    def train(self, train_input, train_output, callback=None):
+        if self.parallel is not None:
+            self.train_parallel(train_input, train_output, callback)
+            return
+        if self.batch_size is not None:
+            self.train_batches(train_input, train_output, callback)
+            return
         for iteration in range(self.epoch):
             for i in range(train_input.shape[0]):
                 self.backpropagation(train_input[i], train_output[i])
+            if callback is not None:
+                callback(iteration + 1, self)
+
+    # Mini-batch training with whole-layer matrix products. The updates of the rows of a batch are summed,
+    # so batch_size=1 gives the same weights as backpropagation() on every row
+    def train_batches(self, train_input, train_output, callback=None):
+        data_size = train_input.shape[0]
+        batch_size = min(self.batch_size, data_size)
+        layers = [self.num_input] + self.num_hidden + [self.num_output]
+        desired_output = np.zeros((data_size, self.num_output))
+        desired_output[np.arange(data_size), train_output.astype(int)] = 1
+
+        # Buffers for activations, deltas and gradients are allocated once for the whole training
+        activations = [np.empty((batch_size, size)) for size in layers]
+        deltas = [np.empty((batch_size, size)) for size in layers[1:]]
+        derivatives = [np.empty((batch_size, size)) for size in layers[1:]]
+        weight_gradients = [np.empty(weights.shape) for weights in self.weights]
+        bias_gradients = [np.empty(size) for size in layers[1:]]
+
+        for iteration in range(self.epoch):
+            for start in range(0, data_size, batch_size):
+                end = min(start + batch_size, data_size)
+                layer_input = [buffer[:end - start] for buffer in activations]
+                delta = [buffer[:end - start] for buffer in deltas]
+                derivative = [buffer[:end - start] for buffer in derivatives]
+
+                # Forward pass, the sigmoid is applied in place
+                layer_input[0][...] = train_input[start:end]
+                for i in range(len(self.weights)):
+                    net = layer_input[i + 1]
+                    np.dot(layer_input[i], self.weights[i], out=net)
+                    net += self.biases[i]
+                    np.negative(net, out=net)
+                    np.exp(net, out=net)
+                    net += 1
+                    np.reciprocal(net, out=net)
+
+                # Output layer delta
+                np.subtract(desired_output[start:end], layer_input[-1], out=delta[-1])
+                np.subtract(1, layer_input[-1], out=derivative[-1])
+                delta[-1] *= layer_input[-1]
+                delta[-1] *= derivative[-1]
+
+                # Backward pass, as in backpropagation() the delta of a layer goes back through the weights
+                # that were just updated
+                for i in range(len(self.weights) - 1, -1, -1):
+                    np.dot(layer_input[i].T, delta[i], out=weight_gradients[i])
+                    weight_gradients[i] *= self.learning_rate
+                    self.weights[i] += weight_gradients[i]
+                    np.sum(delta[i], axis=0, out=bias_gradients[i])
+                    bias_gradients[i] *= self.learning_rate
+                    self.biases[i] += bias_gradients[i]
+
+                    if i > 0:
+                        np.dot(delta[i], self.weights[i].T, out=delta[i - 1])
+                        np.subtract(1, layer_input[i], out=derivative[i - 1])
+                        delta[i - 1] *= layer_input[i]
+                        delta[i - 1] *= derivative[i - 1]
+            if callback is not None:
+                callback(iteration + 1, self)
+
+    # Data-parallel training, every worker process trains on its own contiguous shard of the data which is
+    # read from shared memory. With 'hogwild' the workers update the parameters in shared memory without
+    # locks, with 'averaging' they train private copies whose average weighted by shard size is taken after
+    # every round. There are never more workers than rows, so no shard is empty
+    def train_parallel(self, train_input, train_output, callback=None):
+        data_size = train_input.shape[0]
+        processes = max(1, min(self.processes or os.cpu_count(), data_size))
+        params = dict(num_input=self.num_input, hidden_layers=self.num_hidden, num_output=self.num_output,
+                      learning_rate=self.learning_rate, batch_size=self.batch_size)
+        shards = np.linspace(0, data_size, processes + 1).astype(int)
+        shard_sizes = np.diff(shards)
+        train_data = np.column_stack((train_input, train_output))
+
+        with SharedArray(train_data) as shared_data:
+            # Only hogwild workers write to shared parameters
+            shared_parameters, parameters_spec = None, None
+            if self.parallel == 'hogwild':
+                shared_parameters = SharedArray(self.parameters)
+                parameters_spec = shared_parameters.spec
+            try:
+                with Pool(processes, initializer=attach_worker,
+                          initargs=({'data': shared_data.spec, 'parameters': parameters_spec},)) as pool:
+                    if self.parallel == 'hogwild':
+                        for iteration in range(self.epoch):
+                            pool.map(train_shard, [(params, shards[i], shards[i + 1], 1, None)
+                                                   for i in range(processes)])
+                            if callback is not None:
+                                self.parameters[...] = shared_parameters.array
+                                callback(iteration + 1, self)
+                        self.parameters[...] = shared_parameters.array
+                    else:
+                        for start in range(0, self.epoch, self.sync_every):
+                            epochs = min(self.sync_every, self.epoch - start)
+                            jobs = [(params, shards[i], shards[i + 1], epochs, self.parameters)
+                                    for i in range(processes)]
+                            self.parameters[...] = np.average(pool.map(train_shard, jobs), axis=0,
+                                                              weights=shard_sizes)
+                            if callback is not None:
+                                callback(start + epochs, self)
+            finally:
+                if shared_parameters is not None:
+                    shared_parameters.close()
+
+    # Mean squared error between the outputs and the desired outputs of the rows of data_in
+    def loss(self, data_in, data_out):
+        output = self.predict_output(data_in)
+        desired_output = np.zeros(output.shape)
+        desired_output[np.arange(output.shape[0]), data_out.astype(int)] = 1
+        return np.mean((desired_output - output) ** 2)
 
     # Returns a predicted value for an input row
     def predict_classification(self, test_row):
-        output = self.forward(test_row)[-1][0]
-        predict = list(map(round, output[0]))
-        for p in predict:
-            if p == 1:
-                return predict.index(p)
-        return 0
+        return int(self.predict_many(test_row)[0])
+
+    # Inference only forward pass, returns the output layer of every row of data_in without keeping the
+    # values of the hidden layers
+    def predict_output(self, data_in):
+        output = np.reshape(data_in, (-1, self.num_input))
+        for i in range(len(self.weights)):
+            output = np.dot(output, self.weights[i])
+            output += self.biases[i]
+            np.negative(output, out=output)
+            np.exp(output, out=output)
+            output += 1
+            np.reciprocal(output, out=output)
+        return output
+
+    # Returns a predicted value for every row of data_in, the first output neuron that rounds to 1 gives the class
+    def predict_many(self, data_in):
+        predict = np.round(self.predict_output(data_in)) == 1
+        return np.where(np.any(predict, axis=1), np.argmax(predict, axis=1), 0)
 
     # Make prediction and measure algorithm performance
     def calculate_performance(self, data_in, data_out):
-        correct = 0
-        for i in range(data_out.shape[0]):
-            prediction = self.predict_classification(data_in[i])
-            real_value = data_out[i]
-            if real_value == prediction:
-                correct += 1
-        accuracy = correct / data_out.shape[0]
+        predictions = self.predict_many(data_in)
+        accuracy = np.count_nonzero(predictions == data_out) / data_out.shape[0]
         return accuracy
 
     def K_fold_validation(self, train_data, k=5):
@@ -133,6 +312,73 @@ class MLP:
         performance = sum(accuracy_list)*100/k
         return performance
 
+    # K fold validation with the folds trained in parallel processes on new networks that have the same
+    # parameters as this one, the result only depends on seed
+    def K_fold_validation_parallel(self, train_data, k=5, seed=1, processes=None):
+        params = dict(num_input=self.num_input, hidden_layers=self.num_hidden, num_output=self.num_output,
+                      learning_rate=self.learning_rate, epoch=self.epoch, batch_size=self.batch_size)
+        accuracy_list = parallel_K_fold_validation(partial(train_fold_model, params), train_data, k, seed, processes)
+        performance = sum(accuracy_list)*100/k
+        return performance
+
+
+# Opens an array stored uncompressed in a .npz file as a memory map, the offset of its data in the file is
+# found from the zip local header and the .npy header of the array
+def memmap_npz_array(file_path, name, mmap_mode='r'):
+    with zipfile.ZipFile(file_path) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("{} is compressed in {} and can not be memory-mapped".format(name, file_path))
+    with open(file_path, 'rb') as file:
+        file.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', file.read(4))
+        file.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+    return np.memmap(file_path, dtype=dtype, mode=mmap_mode, shape=shape, offset=offset,
+                     order='F' if fortran_order else 'C')
+
+
+# Trains a network on the rows start..end of the shared data for some epochs. Without parameters the
+# network works directly on the shared parameters, otherwise it trains a copy of them and returns it
+def train_shard(job):
+    params, start, end, epochs, parameters = job
+    shard = worker_arrays['data'][start:end]
+    shared = parameters is None
+    if shared:
+        parameters = worker_arrays['parameters']
+    mlp = MLP(epoch=epochs, parameters=parameters, **params)
+    mlp.train(shard[:, :-1], shard[:, -1])
+    if not shared:
+        return mlp.parameters
+
+
+# Trains the same initial network serially and with both parallel modes, and returns for every mode a list of
+# (epoch, seconds, loss) that compares their convergence on the train data
+def convergence_report(train_input, train_output, processes=None, **params):
+    initial = MLP(**params).parameters
+    report = dict()
+    for mode in (None, 'hogwild', 'averaging'):
+        mlp = MLP(parameters=initial.copy(), parallel=mode, processes=processes, **params)
+        history = list()
+        start = time.perf_counter()
+        mlp.train(train_input, train_output,
+                  callback=lambda epoch, model: history.append(
+                      (epoch, time.perf_counter() - start, model.loss(train_input, train_output))))
+        report[mode or 'serial'] = history
+    return report
+
+
+# Builds and trains a network on the train data of a fold
+def train_fold_model(params, train_data):
+    mlp = MLP(**params)
+    mlp.train(train_data[:, :-1], train_data[:, -1])
+    return mlp
+
 
 def main():
     # Import train data
@@ -168,7 +414,13 @@ def main():
     print('\nPlease wait ...\n')
 
     mlp = MLP()
-    print('Performance with K fold validation:\n{:.2f}%'.format(mlp.K_fold_validation(data_train)))
+    print('Performance with K fold validation:\n{:.2f}%'.format(mlp.K_fold_validation_parallel(data_train)))
+
+    # Comparing the convergence of the parallel training modes with the serial training
+    report = convergence_report(data_train[:, :-1], data_train[:, -1], epoch=200, batch_size=8)
+    print('\nTraining loss after 200 epochs:')
+    for mode, history in report.items():
+        print('{:>9}: {:.4f} in {:.2f} seconds'.format(mode, history[-1][2], history[-1][1]))
 
 
 if __name__ == '__main__':
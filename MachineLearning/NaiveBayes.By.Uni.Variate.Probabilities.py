@@ -14,11 +14,10 @@ def univariate_discrimination(train_data, class_label, test_row):
     prior = train_data[np.where(train_data[:, -1] == class_label)].shape[0]/train_data.shape[0]
     d = class_data.shape[1] - 1
     class_mean = np.array(dataset_mean(train_data, class_label))
-    discrimination = 1
+    discrimination = 0
     for i in range(d):
         dim_var = np.var(class_data[:, i])
-        dim_std = np.std(class_data[:, i])
-        discrimination = - 0.5 * np.log(2 * np.pi) - 0.5 * np.log(dim_std) - np.subtract(test_row, class_mean)[i] ** 2\
+        discrimination += - 0.5 * np.log(2 * np.pi) - 0.5 * np.log(dim_var) - np.subtract(test_row, class_mean)[i] ** 2\
             / (2 * dim_var)
     discrimination += np.log(prior)
     return discrimination
@@ -35,6 +34,74 @@ def predict_classification(train_data, test_row):
     return predict
 
 
+class GaussianNaiveBayes:
+    # var_smoothing times the largest variance is added to all variances to avoid dividing by zero
+    def __init__(self, var_smoothing=1e-9):
+        self.var_smoothing = var_smoothing
+        self.classes = np.empty(0)
+        # Number of rows, mean row and sum of squared deviations from the mean row of every class
+        self.counts = None
+        self.means = None
+        self.squares = None
+
+    # Computes the class statistics of train_data from scratch
+    def fit(self, train_data):
+        self.classes = np.empty(0)
+        self.counts = None
+        self.means = None
+        self.squares = None
+        return self.partial_fit(train_data)
+
+    # Merges a chunk of rows into the class statistics with Welford's update in its batched form,
+    # so the model can be trained on a stream of chunks at constant memory
+    def partial_fit(self, chunk):
+        chunk_in = chunk[:, :-1]
+        chunk_out = chunk[:, -1]
+
+        # Making room for the classes that are seen for the first time
+        classes = np.union1d(self.classes, chunk_out)
+        if self.counts is None or classes.shape[0] != self.classes.shape[0]:
+            counts = np.zeros(classes.shape[0])
+            means = np.zeros((classes.shape[0], chunk_in.shape[1]))
+            squares = np.zeros((classes.shape[0], chunk_in.shape[1]))
+            if self.counts is not None:
+                position = np.searchsorted(classes, self.classes)
+                counts[position] = self.counts
+                means[position] = self.means
+                squares[position] = self.squares
+            self.classes, self.counts, self.means, self.squares = classes, counts, means, squares
+
+        labels = np.searchsorted(self.classes, chunk_out)
+        for c in np.unique(labels):
+            class_data = chunk_in[labels == c]
+            chunk_count = class_data.shape[0]
+            chunk_mean = np.mean(class_data, axis=0)
+            chunk_squares = np.sum((class_data - chunk_mean) ** 2, axis=0)
+
+            count = self.counts[c] + chunk_count
+            delta = chunk_mean - self.means[c]
+            self.means[c] += delta * chunk_count / count
+            self.squares[c] += chunk_squares + delta ** 2 * self.counts[c] * chunk_count / count
+            self.counts[c] = count
+        return self
+
+    # Returns the log-likelihood of every class for every row of test_matrix
+    def log_likelihood(self, test_matrix):
+        test_matrix = np.atleast_2d(np.asarray(test_matrix, dtype=float))
+        variances = self.squares / self.counts[:, np.newaxis]
+        variances += self.var_smoothing * np.max(variances)
+        precisions = 1 / variances
+        return np.log(self.counts / np.sum(self.counts)) - 0.5 * np.sum(np.log(2 * np.pi * variances), axis=1) - \
+            0.5 * (np.dot(test_matrix ** 2, precisions.T) - 2 * np.dot(test_matrix, (self.means * precisions).T) +
+                   np.sum(self.means ** 2 * precisions, axis=1))
+
+    def predict_many(self, test_matrix):
+        return self.classes[np.argmax(self.log_likelihood(test_matrix), axis=1)]
+
+    def predict_classification(self, test_row):
+        return self.predict_many(test_row)[0]
+
+
 def main():
     # Import train data
     input_path = path.join('..', 'Data', 'iris', 'iris_train.csv')
@@ -49,10 +116,13 @@ def main():
     test_output_path = path.join('..', 'Data', 'iris', 'iris_test_label.csv')
     data_test_out = np.loadtxt(test_output_path, delimiter=',')
 
+    naive_bayes = GaussianNaiveBayes().fit(train_data)
+    predictions = naive_bayes.predict_many(data_test_in)
+
     correct = 0
-    # With this loop, we classify all the test dataset row and measure performance
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(len(data_test_out)):
-        prediction = predict_classification(train_data, data_test_in[i])
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}.'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
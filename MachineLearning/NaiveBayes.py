@@ -7,6 +7,8 @@ class NaiveBayes:
         self.train_data = train_data
         self.mean_row = None
         self.cov_matrix = None
+        self.classes = None
+        self.class_models = None
 
     def get_mean(self, class_label):
         class_data = self.train_data[np.where(self.train_data[:, -1] == class_label)]
@@ -29,15 +31,36 @@ class NaiveBayes:
                          (test_row - self.mean_row))
         return discrimination
 
+    # Caches the mean row, the Cholesky factor of the covariance matrix, its log determinant and the log prior
+    # of every class, so they are not computed again for every test row
+    def fit(self):
+        self.classes = np.unique(self.train_data[:, -1])
+        self.class_models = list()
+        for class_label in self.classes:
+            class_data = self.train_data[np.where(self.train_data[:, -1] == class_label)][:, :-1]
+            mean_row = np.mean(class_data, axis=0)
+            cholesky = np.linalg.cholesky(np.cov(class_data, rowvar=False))
+            log_det = 2 * np.sum(np.log(np.diag(cholesky)))
+            log_prior = np.log(class_data.shape[0] / self.train_data.shape[0])
+            self.class_models.append((mean_row, cholesky, log_det, log_prior))
+        return self
+
+    # Returns the predicted class of every row of test_matrix. The Mahalanobis terms of all rows are obtained
+    # with one solve against the Cholesky factor of each class instead of inverting the covariance matrix
+    def predict_many(self, test_matrix):
+        if self.class_models is None:
+            self.fit()
+        test_matrix = np.atleast_2d(np.asarray(test_matrix, dtype=float))
+        d = test_matrix.shape[1]
+        discrimination = np.empty((test_matrix.shape[0], self.classes.shape[0]))
+        for c, (mean_row, cholesky, log_det, log_prior) in enumerate(self.class_models):
+            whitened = np.linalg.solve(cholesky, (test_matrix - mean_row).T)
+            mahalanobis = np.einsum('ij,ij->j', whitened, whitened)
+            discrimination[:, c] = log_prior - 0.5 * d * np.log(2 * np.pi) - 0.5 * log_det - 0.5 * mahalanobis
+        return self.classes[np.argmax(discrimination, axis=1)]
+
     def predict_classification(self, test_row):
-        train_outputs = set(self.train_data[:, -1])
-        results = list()
-        for class_label in train_outputs:
-            discrimination = self.multivariate_discrimination(class_label, test_row)
-            results.append((class_label, discrimination))
-        results.sort(key=lambda tup: tup[1])
-        predict = results[-1][0]
-        return predict
+        return self.predict_many(test_row)[0]
 
 
 def main():
@@ -54,11 +77,12 @@ def main():
     test_output_path = path.join('..', 'Data', 'iris', 'iris_test_label.csv')
     data_test_out = np.loadtxt(test_output_path, delimiter=',')
 
-    naivebayes = NaiveBayes(train_data)
+    naivebayes = NaiveBayes(train_data).fit()
+    predictions = naivebayes.predict_many(data_test_in)
     correct = 0
-    # With this loop, we classify all the test dataset row and measure performance
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(len(data_test_out)):
-        prediction = naivebayes.predict_classification(data_test_in[i])
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}.'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
@@ -26,16 +26,61 @@ def predict_classification(train, test_row):
     return prediction
 
 
-# We can calculate the algorithm accuracy with having real outputs
-def calculate_accuracy(self, train, test_in, test_out):
-    correct = 0.0
-    for i in range(test_in.shape[0]):
-        prediction = self.predict_classification(train, test_in[i])
-        real_value = test_out[i]
-        if real_value == prediction:
-            correct += 1.0
-    accuracy = correct / test_in.shape[0]
-    return accuracy
+class NearestMean:
+    def __init__(self):
+        self.classes = np.empty(0)
+        # Running sums of the rows of every class and the number of rows, centroids = sums / counts
+        self.sums = None
+        self.counts = None
+        self.centroids = None
+
+    # Computes the centroids of train from scratch
+    def fit(self, train):
+        self.classes = np.empty(0)
+        self.sums = None
+        self.counts = None
+        return self.partial_fit(train)
+
+    # Updates the centroids with a chunk of training rows, so the model can learn from a stream of chunks
+    def partial_fit(self, chunk):
+        chunk_in = chunk[:, :-1]
+        chunk_out = chunk[:, -1]
+
+        # Making room for the classes that are seen for the first time
+        classes = np.union1d(self.classes, chunk_out)
+        if self.sums is None or classes.shape[0] != self.classes.shape[0]:
+            sums = np.zeros((classes.shape[0], chunk_in.shape[1]))
+            counts = np.zeros(classes.shape[0])
+            if self.sums is not None:
+                position = np.searchsorted(classes, self.classes)
+                sums[position] = self.sums
+                counts[position] = self.counts
+            self.classes, self.sums, self.counts = classes, sums, counts
+
+        labels = np.searchsorted(self.classes, chunk_out)
+        membership = labels[:, np.newaxis] == np.arange(self.classes.shape[0])
+        self.sums += np.dot(membership.T, chunk_in)
+        self.counts += np.count_nonzero(membership, axis=0)
+
+        self.centroids = self.sums / self.counts[:, np.newaxis]
+        return self
+
+    # Returns the class of the nearest centroid for every row of test_matrix
+    def predict_many(self, test_matrix):
+        test_matrix = np.atleast_2d(np.asarray(test_matrix, dtype=float))
+        distances = np.einsum('ij,ij->i', test_matrix, test_matrix)[:, np.newaxis] - \
+            2 * np.dot(test_matrix, self.centroids.T) + np.einsum('ij,ij->i', self.centroids, self.centroids)
+        return self.classes[np.argmin(distances, axis=1)]
+
+    # We can classify an input data by the fitted centroids with predict_classification() function
+    def predict_classification(self, test_row):
+        return self.predict_many(test_row)[0]
+
+    # We can calculate the algorithm accuracy with having real outputs
+    def calculate_accuracy(self, test_in, test_out):
+        predictions = self.predict_many(test_in)
+        accuracy = np.count_nonzero(predictions == test_out) / test_in.shape[0]
+        return accuracy
 
 
 def main():
@@ -52,10 +97,16 @@ def main():
     test_output_path = path.join('..', 'Data', 'iris', 'iris_test_label.csv')
     data_test_out = np.loadtxt(test_output_path, delimiter=',')
 
+    # The centroids are learned from chunks of the training data as if they were streamed
+    nearest_mean = NearestMean()
+    for chunk in np.array_split(train_data, 4):
+        nearest_mean.partial_fit(chunk)
+    predictions = nearest_mean.predict_many(data_test_in)
+
     correct = 0
-    # With this loop, we classify all the test dataset row and measure performance
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(len(data_test_out)):
-        prediction = predict_classification(train_data, data_test_in[i])
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}.'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
@@ -8,7 +8,8 @@ from os import path
 
 
 class voting_combiner:
-    def __init__(self, input_data, output_data):
+    # cache_dir keeps the clustering of the RBF expert between runs on the same data
+    def __init__(self, input_data, output_data, cache_dir=None):
         train_data = np.column_stack((input_data, output_data))
         self.num_experts = 5
 
@@ -18,7 +19,7 @@ class voting_combiner:
         self.ex2 = KNN(train_data, 10)
         self.ex3 = ParzenWindow(train_data, radius=0.7)
 
-        self.ex4 = RBF(train_data)
+        self.ex4 = RBF(train_data, cache_dir=cache_dir)
         self.ex4.train()
 
         self.ex5 = NaiveBayes(train_data)
@@ -50,7 +51,9 @@ def main():
     data_test_out = np.loadtxt(test_output_path, delimiter=',')
 
     correct = 0
-    static_combiner = voting_combiner(input_data, output_data)
+    # The clustering of the RBF expert is kept here and reused by later runs
+    cache_dir = path.join('..', 'Results', 'cache')
+    static_combiner = voting_combiner(input_data, output_data, cache_dir=cache_dir)
     # With this loop, we classify all the test dataset row and measure performance
     for i in range(len(data_test_out)):
         prediction = static_combiner.predict_classification(data_test_in[i])
@@ -1,4 +1,5 @@
 import numpy as np
+from KNearestNeighbor import distance_blocks, nearest_rows, majority_vote, MEMORY_LIMIT
 from os import path
 
 
@@ -23,6 +24,85 @@ def predict_classification(train, test_row):
     return prediction
 
 
+# Returns the predicted values of all rows of test_matrix with blocked matrix operations
+def predict_many(train, test_matrix, memory_limit=MEMORY_LIMIT):
+    if train.shape[0] == 0:
+        raise ValueError("There are no training rows, e.g. prototype reduction removed every row")
+    test_matrix = np.asarray(test_matrix, dtype=float)
+    predictions = np.empty(test_matrix.shape[0])
+    for start, end, distances in distance_blocks(train[:, :-1], test_matrix, memory_limit):
+        nearest = nearest_rows(distances, 1, train[:, :-1], test_matrix[start:end])[:, 0]
+        predictions[start:end] = train[nearest, -1]
+    return predictions
+
+
+# Wilson editing, removes the rows that are misclassified by their k nearest neighbors among the other rows
+def edit_prototypes(train, k=3, memory_limit=MEMORY_LIMIT):
+    if not 0 < k < train.shape[0]:
+        raise ValueError("k must be between 1 and the number of rows minus one: {}".format(k))
+    train_in = train[:, :-1]
+    train_out = train[:, -1]
+    classes = np.unique(train_out)
+    keep = np.empty(train.shape[0], dtype=bool)
+    for start, end, distances in distance_blocks(train_in, train_in, memory_limit):
+        # A row can not be its own neighbor
+        distances[np.arange(end - start), np.arange(start, end)] = np.inf
+        nearest = nearest_rows(distances, k, train_in, train_in[start:end])
+        keep[start:end] = majority_vote(train_out[nearest], classes) == train_out[start:end]
+    return train[keep]
+
+
+# Hart's condensed nearest neighbor, keeps a subset of rows that classifies every row of train correctly
+def condense_prototypes(train, block_size=256):
+    train_in = train[:, :-1]
+    train_out = train[:, -1]
+    data_size = train.shape[0]
+    if data_size == 0:
+        return train
+    in_store = np.zeros(data_size, dtype=bool)
+    in_store[0] = True
+    store = [0]
+
+    # Passing over the data until no row is added to the store
+    changed = True
+    while changed:
+        changed = False
+        start = 0
+        while start < data_size:
+            block = np.arange(start, min(start + block_size, data_size))
+            nearest = np.empty(block.shape[0], dtype=int)
+            for begin, end, distances in distance_blocks(train_in[store], train_in[block]):
+                nearest[begin:end] = nearest_rows(distances, 1, train_in[store], train_in[block][begin:end])[:, 0]
+            wrong = np.flatnonzero((train_out[store][nearest] != train_out[block]) & ~in_store[block])
+            if wrong.shape[0] == 0:
+                start = block[-1] + 1
+                continue
+            # The first misclassified row joins the store and the rest of the block is checked again
+            row = block[wrong[0]]
+            store.append(row)
+            in_store[row] = True
+            changed = True
+            start = row + 1
+    return train[np.sort(store)]
+
+
+# Wilson editing followed by Hart's condensing. The result has the same layout as train, so it can be used
+# in place of the training matrix in predict_classification() and predict_many()
+def reduce_prototypes(train, k=3):
+    edited = edit_prototypes(train, k)
+    prototypes = condense_prototypes(edited)
+    return prototypes
+
+
+# The reduced set is stored as a csv file like the training data
+def save_prototypes(prototypes, file_path):
+    np.savetxt(file_path, prototypes, delimiter=',')
+
+
+def load_prototypes(file_path):
+    return np.loadtxt(file_path, delimiter=',', ndmin=2)
+
+
 def main():
     # Import train data
     input_path = path.join('..', 'Data', 'iris', 'iris_train.csv')
@@ -39,9 +119,10 @@ def main():
 
     test_size = len(data_test_out)
     correct = 0
-    # With this loop, we classify all the test dataset row and measure performance
+    predictions = predict_many(train_data, data_test_in)
+    # With this loop, we check all the test dataset predictions and measure performance
     for i in range(test_size):
-        prediction = predict_classification(train_data, data_test_in[i])
+        prediction = predictions[i]
         real_value = data_test_out[i]
         print('For {} Expected {}, Got {}'.format(data_test_in[i], real_value, prediction), end='  ')
         if real_value == prediction:
@@ -52,6 +133,13 @@ def main():
     performance = float(correct) / test_size
     print("\nAccuracy is:   {:.2f} %".format(performance * 100))
 
+    # Classifying the test dataset with the reduced set of prototypes
+    prototypes = reduce_prototypes(train_data)
+    predictions = predict_many(prototypes, data_test_in)
+    performance = np.count_nonzero(predictions == data_test_out) / test_size
+    print("\nPrototypes kept: {} of {}".format(prototypes.shape[0], train_data.shape[0]))
+    print("Accuracy with prototypes is:   {:.2f} %".format(performance * 100))
+
 
 if __name__ == "__main__":
     main()
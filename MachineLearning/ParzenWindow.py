@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 from os import path
 
@@ -11,13 +12,73 @@ def euclidean_distance(row1, row2):
     return distance
 
 
+# Upper bound in bytes for the arrays of a block of test rows in radius_sweep()
+MEMORY_LIMIT = 256 * 2 ** 20
+
+
+# Euclidean distances between every test row and every train row, summed column by column in the same
+# order as euclidean_distance(), so the radius comparisons give the same results
+def matrix_distance(train_in, test_matrix):
+    distance = np.zeros((test_matrix.shape[0], train_in.shape[0]))
+    for i in range(train_in.shape[1]):
+        distance += (test_matrix[:, i, np.newaxis] - train_in[np.newaxis, :, i]) ** 2
+    distance = np.sqrt(distance)
+    return distance
+
+
+class GridIndex:
+    # Uniform grid with cells of size radius, the rows inside the window of a test row can only be in the
+    # 3^d cells around the cell of the test row, so it is only built for at most 10 dimensions
+    def __init__(self, points, radius):
+        self.points = np.array(points, dtype=float)
+        if self.points.shape[1] > 10:
+            raise ValueError("A grid index searches 3^d cells, it needs at most 10 dimensions: {}"
+                             .format(self.points.shape[1]))
+        self.radius = radius
+        cells = np.floor(self.points / radius).astype(np.int64)
+
+        # Every cell maps to the row numbers inside it
+        order = np.lexsort(cells.T[::-1])
+        sorted_cells = cells[order]
+        starts = np.flatnonzero(np.any(sorted_cells[1:] != sorted_cells[:-1], axis=1)) + 1
+        starts = np.concatenate(([0], starts))
+        self.cells = dict(zip(map(tuple, sorted_cells[starts].tolist()), np.split(order, starts[1:])))
+        self.offsets = np.array(list(itertools.product((-1, 0, 1), repeat=self.points.shape[1])))
+
+    # Returns the row numbers inside the window of test_row in ascending order
+    def query(self, test_row):
+        cell = np.floor(np.asarray(test_row, dtype=float) / self.radius).astype(np.int64)
+        candidates = [self.cells[key] for key in map(tuple, (cell + self.offsets).tolist()) if key in self.cells]
+        if not candidates:
+            return np.empty(0, dtype=int)
+        candidates = np.sort(np.concatenate(candidates))
+        distances = matrix_distance(self.points[candidates], np.reshape(test_row, (1, -1)))[0]
+        return candidates[distances <= self.radius]
+
+
 class ParzenWindow:
-    def __init__(self, train_data, radius=1):
+    # index can be None to compare test rows with every train row or 'grid' for a grid of cells of size radius
+    def __init__(self, train_data, radius=1, index=None):
         self.radius = radius
         self.train_data = train_data
 
+        if index is None:
+            self.index = None
+        elif index == 'grid':
+            self.index = GridIndex(train_data[:, :-1], radius)
+        else:
+            raise ValueError("Unknown window index: {}".format(index))
+
     # We can classify an input data by the training data with predict_classification() function
     def predict_classification(self, test_row):
+        if self.index is not None:
+            output_values = self.train_data[self.index.query(test_row), -1].tolist()
+            if output_values:
+                prediction = max(set(output_values), key=output_values.count)
+                return prediction
+            else:
+                return 0
+
         distances = list()
         for train_row in self.train_data:
             dist = euclidean_distance(test_row, train_row)
@@ -46,6 +107,43 @@ class ParzenWindow:
         accuracy = correct / test_in.shape[0]
         return accuracy
 
+    # Returns a list of (radius, accuracy) for every radius in radius_values. The distances of each test row
+    # are computed and sorted once, and the vote of every radius is read from cumulative class counts
+    def radius_sweep(self, test_in, test_out, radius_values, memory_limit=MEMORY_LIMIT):
+        train_in = self.train_data[:, :-1]
+        train_out = self.train_data[:, -1]
+        classes = np.unique(train_out)
+        radius_values = np.asarray(radius_values)
+        train_size = train_in.shape[0]
+        block_size = max(1, memory_limit // (train_size * (32 + 4 * classes.shape[0])))
+        correct = np.zeros(radius_values.shape[0])
+
+        for start in range(0, test_in.shape[0], block_size):
+            block = test_in[start:start + block_size]
+            distances = matrix_distance(train_in, block)
+            order = np.argsort(distances, axis=1)
+            sorted_distances = np.take_along_axis(distances, order, axis=1)
+
+            # counts[i, j, c] is the number of class c rows among the j nearest train rows of test row i
+            counts = np.zeros((block.shape[0], train_size + 1, classes.shape[0]), dtype=np.int32)
+            np.cumsum(train_out[order][:, :, np.newaxis] == classes, axis=1, out=counts[:, 1:])
+
+            # Number of train rows inside the window of every radius
+            inside = np.array([np.searchsorted(row, radius_values, side='right') for row in sorted_distances])
+            votes = counts[np.arange(block.shape[0])[:, np.newaxis], inside]
+            predictions = np.where(inside > 0, classes[np.argmax(votes, axis=2)], 0)
+
+            # A tie is broken by the same expression as in predict_classification(), on the labels of the
+            # window in the order of the train rows
+            tied = np.count_nonzero(votes == np.max(votes, axis=2)[:, :, np.newaxis], axis=2) > 1
+            for i, j in zip(*np.nonzero(tied & (inside > 0))):
+                output_values = list(train_out[np.sort(order[i, :inside[i, j]])])
+                predictions[i, j] = max(set(output_values), key=output_values.count)
+            correct += np.count_nonzero(predictions == test_out[start:start + block_size, np.newaxis], axis=0)
+
+        accuracies = correct / test_in.shape[0]
+        return list(zip(radius_values, accuracies))
+
 
 def main():
     # Import train data
@@ -78,11 +176,7 @@ def main():
     print("\nAccuracy on test data: {:.2f}%\n".format(performance * 100))
 
     radius_values = np.arange(0.1, 10, 0.05)
-    accuracies = list()
-    for radius in radius_values:
-        parzen_algorithm = ParzenWindow(train_data, radius)
-        accuracy = parzen_algorithm.calculate_accuracy(data_test_in, data_test_out)
-        accuracies.append((radius, accuracy))
+    accuracies = parzen_algorithm.radius_sweep(data_test_in, data_test_out, radius_values)
     accuracies.sort(key=lambda tup: (-tup[1], tup[0]))
     print("The best case for test data is:\nRadius = {:.2f}\nAccuracy = {:.2f}%"
           .format(accuracies[0][0], accuracies[0][1] * 100))
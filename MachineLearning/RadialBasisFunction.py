@@ -1,5 +1,9 @@
+import hashlib
+import os
 import numpy as np
+from functools import partial
 from Kmeans import Kmeans
+from KFoldValidation import parallel_K_fold_validation
 from os import path
 
 
@@ -24,16 +28,61 @@ def euclidean_distance(row1, row2):
     return distance
 
 
+# Runs the clustering that chooses the number of hidden neurons, their centers and their spreads. With cache_dir
+# the result is stored in a file named by a hash of the dataset and the clustering parameters, and is read
+# from there when the same dataset is clustered again. The global random state is restored after clustering,
+# so the draws that follow are the same whether the result came from the cache or not
+def select_centers(dataset, max_K=10, iteration=30, cache_dir=None):
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(np.ascontiguousarray(dataset).tobytes())
+        key.update(repr((dataset.shape, dataset.dtype.str, max_K, iteration)).encode())
+        cache_path = path.join(cache_dir, 'rbf_centers_{}.npz'.format(key.hexdigest()))
+        if path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                return int(cached['num_hidden']), cached['centers'], cached['spreads']
+
+    random_state = np.random.get_state()
+    kmeans = Kmeans()
+    num_hidden = kmeans.find_optimal_K(dataset, max_K, iteration)
+    # print("\nThe optimal number of hidden neurons was found:\nK = {}\n".format(num_hidden))
+    kmeans.K_means(dataset, num_hidden)
+    np.random.set_state(random_state)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_path, num_hidden=num_hidden, centers=kmeans.centers, spreads=kmeans.clusters_variance)
+    return num_hidden, kmeans.centers, kmeans.clusters_variance
+
+
 class RBF:
     # Initialization function
-    def __init__(self, dataset, num_input=4, num_output=3, learning_rate=0.01, epoch=1000):
+    # solver is 'delta' for the per-row delta rule, 'batch_gradient' for full batch gradient steps or
+    # 'least_squares' for solving the output layer directly with regularized least squares.
+    # Precomputed centers (and optionally their spreads) skip the clustering, otherwise the clustering
+    # result is cached in cache_dir when it is given
+    def __init__(self, dataset, num_input=4, num_output=3, learning_rate=0.01, epoch=1000, solver='delta',
+                 regularization=1e-3, centers=None, spreads=None, cache_dir=None, max_K=10, iteration=30):
+        if solver not in ('delta', 'batch_gradient', 'least_squares'):
+            raise ValueError("Unknown solver: {}".format(solver))
         self.dataset = dataset
         self.num_input = num_input
         self.num_output = num_output
-
-        kmeans = Kmeans()
-        self.num_hidden = kmeans.find_optimal_K(self.dataset)
-        # print("\nThe optimal number of hidden neurons was found:\nK = {}\n".format(self.num_hidden))
+        self.solver = solver
+        self.regularization = regularization
+        self.cache_dir = cache_dir
+        self.max_K = max_K
+        self.iteration = iteration
+
+        if centers is None:
+            self.num_hidden, self.centers, self.spreads = select_centers(self.dataset, max_K, iteration, cache_dir)
+        else:
+            self.centers = np.asarray(centers, dtype=float)
+            self.num_hidden = self.centers.shape[0]
+            if spreads is None:
+                self.spreads = self.center_spreads()
+            else:
+                self.spreads = np.reshape(spreads, (self.num_hidden, 1))
 
         self.learning_rate = learning_rate
         self.epoch = epoch
@@ -41,49 +90,79 @@ class RBF:
         self.output_layer_biases = np.random.uniform(-2, 2, (1, self.num_output))
         self.hidden_neurons = np.empty((1, self.num_hidden))
 
-        kmeans.K_means(self.dataset, self.num_hidden)
-        self.centers = kmeans.centers
-        self.spreads = kmeans.clusters_variance
+    # Spreads of given centers, as in K_means() the spread of a center is the mean distance between
+    # the center and the rows that are nearest to it
+    def center_spreads(self):
+        data_in = self.dataset[:, :self.num_input]
+        distance = np.zeros((data_in.shape[0], self.num_hidden))
+        for i in range(self.num_input):
+            distance += (data_in[:, i, np.newaxis] - self.centers[np.newaxis, :, i]) ** 2
+        distance = np.sqrt(distance)
+        nearest = np.argmin(distance, axis=1)
+        counts = np.bincount(nearest, minlength=self.num_hidden)
+        sums = np.bincount(nearest, weights=distance[np.arange(data_in.shape[0]), nearest], minlength=self.num_hidden)
+        spreads = np.ones((self.num_hidden, 1))
+        spreads[counts > 0, 0] = sums[counts > 0] / counts[counts > 0]
+        return spreads
+
+    # Gaussian activations of the hidden neurons for every row of data_in as a (rows, centers) matrix, the
+    # distances are summed column by column like euclidean_distance()
+    def design_matrix(self, data_in):
+        data_in = np.reshape(data_in, (-1, self.num_input))
+        distance = np.zeros((data_in.shape[0], self.num_hidden))
+        for i in range(data_in.shape[1]):
+            distance += (data_in[:, i, np.newaxis] - self.centers[np.newaxis, :, i]) ** 2
+        return Gaussian(np.sqrt(distance), self.spreads[:, 0])
 
     def train(self):
-        for epoch in range(self.epoch):
-            for row in self.dataset:
-                for i in range(self.num_hidden):
-                    r = euclidean_distance(row[:-1], self.centers[i, :])
-                    sig = self.spreads[i][0]
-                    self.hidden_neurons[0][i] = Gaussian(r, sig)
-
-                # Calculate error in output layer for use in delta rule
-                output = sigmoid(np.dot(self.hidden_neurons, self.output_layer_weights) + self.output_layer_biases)
-                desired_output = np.zeros((1, self.num_output))
-                desired_output[0][int(row[-1])] = 1
-                error = np.subtract(desired_output, output)
-
-                # Updating output layer weights
-                self.output_layer_weights += self.learning_rate * np.dot(self.hidden_neurons.T, error)
-                self.output_layer_biases += self.learning_rate * error
+        # The hidden activations do not change during training, so they are computed once
+        hidden_neurons = self.design_matrix(self.dataset[:, :self.num_input])
+        data_size = self.dataset.shape[0]
+        desired_output = np.zeros((data_size, self.num_output))
+        desired_output[np.arange(data_size), self.dataset[:, -1].astype(int)] = 1
+
+        if self.solver == 'least_squares':
+            # The targets of the output layer are the logits of 0.9 and 0.1, their sigmoid rounds to 1 and 0
+            target = np.where(desired_output == 1, np.log(9), -np.log(9))
+            design = np.column_stack((hidden_neurons, np.ones(data_size)))
+            solution = np.linalg.solve(np.dot(design.T, design) + self.regularization * np.eye(design.shape[1]),
+                                       np.dot(design.T, target))
+            self.output_layer_weights = solution[:-1]
+            self.output_layer_biases = solution[-1:]
+
+        elif self.solver == 'batch_gradient':
+            for epoch in range(self.epoch):
+                output = sigmoid(np.dot(hidden_neurons, self.output_layer_weights) + self.output_layer_biases)
+                error = desired_output - output
+                self.output_layer_weights += self.learning_rate * np.dot(hidden_neurons.T, error)
+                self.output_layer_biases += self.learning_rate * np.sum(error, axis=0)
+
+        else:
+            for epoch in range(self.epoch):
+                for i in range(data_size):
+                    self.hidden_neurons = hidden_neurons[i:i + 1]
+
+                    # Calculate error in output layer for use in delta rule
+                    output = sigmoid(np.dot(self.hidden_neurons, self.output_layer_weights) + self.output_layer_biases)
+                    error = np.subtract(desired_output[i:i + 1], output)
+
+                    # Updating output layer weights
+                    self.output_layer_weights += self.learning_rate * np.dot(self.hidden_neurons.T, error)
+                    self.output_layer_biases += self.learning_rate * error
+
+    # Returns a predicted value for every row of data_in, the first output neuron that rounds to 1 gives the class
+    def predict_many(self, data_in):
+        output = sigmoid(np.dot(self.design_matrix(data_in), self.output_layer_weights) + self.output_layer_biases)
+        predict = np.round(output) == 1
+        return np.where(np.any(predict, axis=1), np.argmax(predict, axis=1), 0)
 
     def predict_classification(self, data_row):
-        for i in range(self.num_hidden):
-            r = euclidean_distance(data_row, self.centers[i, :])
-            sig = self.spreads[i][0]
-            self.hidden_neurons[0][i] = Gaussian(r, sig)
-        output = sigmoid(np.dot(self.hidden_neurons, self.output_layer_weights) + self.output_layer_biases)
-        predict = list(map(round, output[0]))
-        for p in predict:
-            if p == 1:
-                return predict.index(p)
-        return 0
+        return int(self.predict_many(data_row)[0])
 
     # Make prediction and measure algorithm performance
     def calculate_performance(self, data_in, data_out):
-        correct = 0
-        for i in range(data_out.shape[0]):
-            prediction = self.predict_classification(data_in[i])
-            real_value = data_out[i]
-            if real_value == prediction:
-                correct += 1
-        accuracy = correct / data_out.shape[0]
+        predictions = self.predict_many(data_in)
+        accuracy = np.count_nonzero(predictions == data_out) / data_out.shape[0]
         return accuracy
 
     def K_fold_validation(self, train_data, k=5):
@@ -102,6 +181,25 @@ class RBF:
         performance = sum(accuracy_list)*100/k
         return performance
 
+    # K fold validation with the folds trained in parallel processes, every fold builds its own network
+    # from its train data with the same parameters as this one, the result only depends on seed
+    def K_fold_validation_parallel(self, train_data, k=5, seed=1, processes=None):
+        params = dict(num_input=self.num_input, num_output=self.num_output, learning_rate=self.learning_rate,
+                      epoch=self.epoch, solver=self.solver, regularization=self.regularization,
+                      cache_dir=self.cache_dir, max_K=self.max_K, iteration=self.iteration)
+        accuracy_list = parallel_K_fold_validation(partial(train_fold_model, params), train_data, k, seed, processes)
+        for accuracy in accuracy_list:
+            print("{:.2f}%".format(accuracy * 100))
+        performance = sum(accuracy_list)*100/k
+        return performance
+
+
+# Builds and trains a network on the train data of a fold
+def train_fold_model(params, train_data):
+    rbf = RBF(train_data, **params)
+    rbf.train()
+    return rbf
+
 
 def main():
     # Import train data
@@ -117,7 +215,7 @@ def main():
     test_output_path = path.join('..', 'Data', 'iris', 'iris_test_label.csv')
     output_test_data = np.loadtxt(test_output_path, delimiter=',')
 
-    rbf = RBF(train_data)
+    rbf = RBF(train_data, solver='least_squares')
     rbf.train()
 
     correct = 0
@@ -133,7 +231,7 @@ def main():
     performance = correct / output_test_data.shape[0]
     print("\nAccuracy on test dataset: {:.2f}%".format(performance * 100))
     print('\nPerformance with K fold validation:\n')
-    print('\nAverage = {:.2f}%'.format(rbf.K_fold_validation(train_data)))
+    print('\nAverage = {:.2f}%'.format(rbf.K_fold_validation_parallel(train_data)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+import mmap
+import numpy as np
+from multiprocessing import shared_memory
+
+
+# Copies an array once into shared memory, so worker processes can read it by name instead of receiving
+# a pickled copy. close() must be called when the workers are done
+class SharedArray:
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.memory.buf)
+        self.array[...] = array
+        # Picklable description of the array that is sent to the workers
+        self.spec = (self.memory.name, array.shape, array.dtype.str)
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Returns the shared memory block and an array that reads it in a worker process, the block has to stay
+# referenced while the array is used
+def attach_array(spec):
+    name, shape, dtype = spec
+    memory = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    return memory, array
+
+
+# Picklable description of a np.memmap that maps a whole file region, a worker maps the same file instead of
+# reading a copy in shared memory. Returns None for any other array
+def memmap_spec(array):
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        return ('memmap', array.filename, array.shape, array.dtype.str, array.offset)
+    return None
+
+
+# The arrays of a worker process by name, they are attached once when the worker starts. The shared memory
+# blocks are kept with them since the arrays read their buffers
+worker_arrays = dict()
+worker_memory = list()
+
+
+# Pool initializer, specs maps a name to the spec of a SharedArray, to a memmap_spec() or to None for an
+# array that the worker does not need
+def attach_worker(specs):
+    for name, spec in specs.items():
+        if spec is None:
+            continue
+        if spec[0] == 'memmap':
+            _, filename, shape, dtype, offset = spec
+            worker_arrays[name] = np.memmap(filename, dtype=dtype, mode='r', shape=shape, offset=offset)
+        else:
+            memory, worker_arrays[name] = attach_array(spec)
+            worker_memory.append(memory)